@@ -0,0 +1,176 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from feeds import timestamp
+from settings import ARCHIVE_DIR, ARCHIVE_SEGMENT_BYTES
+from statedb import connect
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+INDEX_FILE = 'index.jsonl'
+# Where the body of every content hash is, so that adding a page does not read the whole index
+BLOBS_FILE = 'blobs.sqlite3'
+# Fast levels, pages are archived while they are downloaded and html compresses well anyway
+ZSTD_LEVEL = 3
+GZIP_LEVEL = 6
+
+
+def compress(body):
+    if zstandard is not None:
+        return '.zst', zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    return '.gz', gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def decompress(segment, data):
+    if segment.endswith('.zst'):
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def encode_dt(dt):
+    """ Timestamp and utc offset in seconds (None for naive dates, which are taken as UTC) """
+    return timestamp(dt), dt.utcoffset().total_seconds() if dt.utcoffset() is not None else None
+
+
+def decode_dt(ts, offset):
+    if offset is None:
+        return datetime.utcfromtimestamp(ts)
+    return datetime.fromtimestamp(ts, timezone(timedelta(seconds=offset)))
+
+
+def read_body(path, segment, offset, length):
+    with open(os.path.join(path, segment), 'rb') as f:
+        f.seek(offset)
+        return decompress(segment, f.read(length))
+
+
+class Archive():
+    """
+    Content addressed archive of the downloaded pages. Every body is compressed on its own (zstd if installed,
+    otherwise gzip) and appended to a segment file, the same body is stored once. An append-only index of json
+    lines, keyed by the hash of the link, keeps where the body is and what is needed to extract it again.
+    Every process appends to its own segments, index lines are written with a single append each.
+    Whether a body is stored already is looked up in a small SQLite table of content hashes next to the segments.
+    The downloads archive with add_async(), which hashes, compresses and writes in one thread of the archive,
+    so the event loop is not blocked and the segment is written by one thread at a time.
+    """
+
+    def __init__(self, path, segment_bytes=ARCHIVE_SEGMENT_BYTES):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self._blobs = None  # connection to BLOBS_FILE, opened by the thread which adds the pages
+        self.segment = None
+        self.segment_file = None
+        self.segment_count = 0
+        self.executor = None
+
+    def load(self):
+        """ Latest index record of every link """
+        records = {}
+        index = os.path.join(self.path, INDEX_FILE)
+        if os.path.exists(index):
+            with open(index, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut by a crash
+                        continue
+                    records[record['link_hash']] = record
+        return records
+
+    @property
+    def blobs(self):
+        if self._blobs is None:
+            os.makedirs(self.path, exist_ok=True)
+            self._blobs = connect(os.path.join(self.path, BLOBS_FILE))
+            with self._blobs:
+                self._blobs.execute('CREATE TABLE IF NOT EXISTS blobs (content_hash TEXT PRIMARY KEY, '
+                                    'segment TEXT NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL)')
+            if not self._blobs.execute('SELECT 1 FROM blobs LIMIT 1').fetchone():
+                self.import_index()
+        return self._blobs
+
+    def import_index(self):
+        """ Take over the bodies of an archive written before BLOBS_FILE, once """
+        rows = [(record['content_hash'], record['segment'], record['offset'], record['length'])
+                for record in self.load().values()]
+        with self._blobs:
+            self._blobs.executemany('INSERT OR IGNORE INTO blobs VALUES (?, ?, ?, ?)', rows)
+
+    def open_segment(self, extension):
+        if self.segment_file is not None:
+            self.segment_file.close()
+        self.segment_count += 1
+        self.segment = '{}-{}-{}{}'.format(time.strftime('%Y%m%d%H%M%S'), os.getpid(), self.segment_count, extension)
+        self.segment_file = open(os.path.join(self.path, self.segment), 'ab')
+
+    def add(self, link, body, publisher, encoding, title, publish_dt):
+        if not self.path:
+            return
+        content_hash = hashlib.sha1(body).hexdigest()
+        blob = self.blobs.execute('SELECT segment, offset, length FROM blobs WHERE content_hash = ?',
+                                  (content_hash,)).fetchone()
+        if blob is None:
+            extension, data = compress(body)
+            if self.segment_file is None or self.segment_file.tell() + len(data) > self.segment_bytes:
+                self.open_segment(extension)
+            offset = self.segment_file.tell()
+            self.segment_file.write(data)
+            self.segment_file.flush()
+            blob = (self.segment, offset, len(data))
+            with self.blobs:
+                # Another process may have stored the same body meanwhile, its copy is as good
+                self.blobs.execute('INSERT OR IGNORE INTO blobs VALUES (?, ?, ?, ?)', (content_hash,) + blob)
+        segment, offset, length = blob
+        publish_ts, publish_offset = encode_dt(publish_dt)
+        record = {'link_hash': hashlib.sha1(link.encode('utf-8')).hexdigest(), 'content_hash': content_hash,
+                  'segment': segment, 'offset': offset, 'length': length, 'archived_at': time.time(),
+                  'link': link, 'publisher': publisher, 'encoding': encoding, 'title': title,
+                  'publish_ts': publish_ts, 'publish_offset': publish_offset}
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        fd = os.open(os.path.join(self.path, INDEX_FILE), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    async def add_async(self, link, body, publisher, encoding, title, publish_dt):
+        if not self.path:
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        await asyncio.get_event_loop().run_in_executor(
+            self.executor, self.add, link, body, publisher, encoding, title, publish_dt)
+
+    def read(self, record):
+        return read_body(self.path, record['segment'], record['offset'], record['length'])
+
+    def close_files(self):
+        if self.segment_file is not None:
+            self.segment_file.close()
+            self.segment_file = None
+        if self._blobs is not None:
+            self._blobs.close()
+            self._blobs = None
+
+    def close(self):
+        if self.executor is not None:
+            # SQLite connections may only be closed by the thread which opened them
+            self.executor.submit(self.close_files)
+            self.executor.shutdown()
+            self.executor = None
+        else:
+            self.close_files()
+
+
+page_archive = Archive(ARCHIVE_DIR)
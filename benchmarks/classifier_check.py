@@ -0,0 +1,72 @@
+"""
+Check of CountryClassifier against the loop over all keywords it replaced, where the last matching group
+of keywords gave the country. Texts are built from a sample of every keyword, alone, in pairs with a sample
+of every other group and in random triples, plus the corpus titles and paragraphs.
+
+    python -m benchmarks.classifier_check --triples 5000
+"""
+import argparse
+import random
+import re
+import sys
+
+from benchmarks.corpus import TITLES, PARAGRAPHS
+from classifier import CountryClassifier
+from settings import COUNTRIES_KEYWORDS
+
+
+def old_define_country(countries_keywords, text):
+    country = None
+    for keywords in countries_keywords.items():
+        for keyword in keywords[0]:
+            p = re.compile(keyword)
+            if p.search(text) or p.search(text.lower()):
+                country = keywords[1]
+    return country
+
+
+def sample(keyword):
+    """ A text the keyword matches, None if the simple rewrite below does not give one """
+    text = re.sub(r'\(\?[=!][^)]*\)', '', keyword)
+    text = re.sub(r'\\[bB]', '', text)
+    text = re.sub(r'\[\^[^\]]*\]', ' ', text)
+    text = re.sub(r'\[(.)[^\]]*\]', r'\1', text)
+    text = re.sub(r'\{[^}]*\}|[?*+]', '', text)
+    text = re.sub(r'\\(.)', r'\1', text)
+    text = ' {} '.format(text)
+    return text if re.search(keyword, text) else None
+
+
+def texts(countries_keywords, triples, seed=0):
+    groups = [[text for text in map(sample, keywords) if text] for keywords in countries_keywords]
+    samples = [text for group in groups for text in group]
+    yield from TITLES + PARAGRAPHS
+    yield from samples
+    for text in samples:
+        for group in groups:
+            if group:
+                yield text + group[0]
+    rnd = random.Random(seed)
+    for _ in range(triples):
+        yield ''.join(rnd.sample(samples, 3))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--triples', type=int, default=5000, help='random texts of three keywords')
+    args = arg_parser.parse_args()
+    classifier = CountryClassifier(COUNTRIES_KEYWORDS, policy='last')
+    checked, differences = 0, 0
+    for text in texts(COUNTRIES_KEYWORDS, args.triples):
+        checked += 1
+        expected = old_define_country(COUNTRIES_KEYWORDS, text)
+        got = classifier.define_country(text)
+        if got != expected:
+            differences += 1
+            print('{!r}: {} instead of {}'.format(text, got, expected))
+    print('{} texts, {} differences'.format(checked, differences))
+    return 1 if differences else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
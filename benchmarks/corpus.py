@@ -0,0 +1,111 @@
+"""
+Corpus for the benchmarks: feed items and article pages of every publisher.
+
+Recorded pages are taken from benchmarks/corpus/<PublisherClass>/ (see record.py), publishers without
+a recording get a synthetic feed and pages, which contain the containers every parse_body looks for.
+"""
+import json
+import os
+import random
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+TITLES = [
+    'ВВС нанесли удар по позициям ИГ в Сирии',
+    'В Донецке возобновились обстрелы, сообщили в ВСУ',
+    'Минобороны Турции сообщило о ракетном ударе',
+    'Израиль перехватил ракету из сектора Газа',
+    'В Афганистане талибы атаковали военную базу',
+    'НАТО усилит ПВО в Прибалтике',
+    'Курс рубля вырос на открытии торгов',
+    'В Москве ожидается снег',
+    'Сборная проиграла в товарищеском матче',
+    'Выставка современного искусства открылась в Петербурге',
+]
+
+PARAGRAPHS = [
+    'Военные сообщили о нескольких ударах по позициям боевиков в районе Алеппо и Дамаска.',
+    'По данным источника, в операции были задействованы самолеты и беспилотники.',
+    'Ранее официальный представитель ведомства заявил о продолжении переговоров.',
+    'Подробности инцидента уточняются, информации о пострадавших пока не поступало.',
+]
+
+ARTICLE_TEMPLATE = '''<!DOCTYPE html>
+<html><head><title>{title}</title><meta charset="{encoding}">
+<style>body {{ font-family: sans-serif; }} .menu {{ display: none; }}</style>
+<script>var counters = [{script}];</script></head>
+<body>
+<div class="menu"><ul>{menu}</ul></div>
+<div class="content">{p}<div class="mainnews"><div>{text}</div></div></div>
+<div class="txt-item-news">{text}</div>
+<h3 id="ctl00_ctl00_ContentPlaceHolder_ContentPlaceHolder_NewsContent1_H1">{title}</h3>
+<p id="ctl00_ctl00_ContentPlaceHolder_ContentPlaceHolder_NewsContent1_BodyLabel">{text}</p>
+<p class="b-article__text">{text}</p>
+<div class="textnews">{text}</div>
+<div class="article__summary">{p}</div><div class="article__text">{p}</div>
+<div class="post-item__text">{text}</div>
+<span itemprop="articleBody">{p}</span>
+<div class="newsHeading">{title}</div><div class="newsText">{p}</div>
+<div class="story-body"><div class="story-body__inner">{p}</div></div>
+<div itemprop="articleBody">{p}</div>
+<div class="articles-body">{p}</div>
+<div class="b-news-item__text b-news-item__text_one">{p}</div>
+<div class="b-material-text__l">{p}</div>
+<div class="newstext">{p}</div>
+<div class="field-name-body"><div class="field-item even">{p}</div></div>
+<div id="text">{text}</div>
+<div class="b-article__text">{p}</div>
+<div class="detail_text">{text}</div>
+<div class="entry">{p}</div>
+<div class="article-post-content">{p}</div>
+<div class="footer">{footer}</div>
+</body></html>'''
+
+
+class PublisherCorpus():
+    def __init__(self, items, pages):
+        self.items = items  # dicts with title, published, summary
+        self.pages = pages  # raw article bytes, one per item
+
+
+def synthetic_page(title, encoding, rnd):
+    paragraphs = [rnd.choice(PARAGRAPHS) for _ in range(4)]
+    page = ARTICLE_TEMPLATE.format(
+        title=title, encoding=encoding,
+        p=''.join('<p>{}</p>'.format(p) for p in paragraphs),
+        text=' '.join(paragraphs),
+        script=','.join(str(rnd.random()) for _ in range(300)),
+        menu=''.join('<li><a href="/section/{0}">Раздел {0}</a></li>'.format(i) for i in range(200)),
+        footer=' '.join(rnd.choice(PARAGRAPHS) for _ in range(30)))
+    return page.encode(encoding, errors='replace')
+
+
+def synthetic_corpus(publisher_class, articles, seed=0):
+    rnd = random.Random('{}-{}'.format(publisher_class.__name__, seed))
+    items, pages = [], []
+    for i in range(articles):
+        title = '{} ({})'.format(TITLES[i % len(TITLES)], i)
+        # Newest first, one entry per ten minutes
+        items.append({'title': title, 'published': 'Mon, 05 Jun 2017 {:02d}:{:02d}:00 +0300'.format(
+            23 - i // 6 % 24, 50 - i % 6 * 10), 'summary': rnd.choice(PARAGRAPHS)})
+        pages.append(synthetic_page(title, publisher_class.encoding, rnd))
+    return PublisherCorpus(items, pages)
+
+
+def recorded_corpus(publisher_class, articles):
+    path = os.path.join(CORPUS_DIR, publisher_class.__name__)
+    if not os.path.exists(os.path.join(path, 'items.json')):
+        return None
+    with open(os.path.join(path, 'items.json'), encoding='utf-8') as f:
+        items = json.load(f)[:articles]
+    pages = []
+    for i in range(len(items)):
+        with open(os.path.join(path, '{}.html'.format(i)), 'rb') as f:
+            pages.append(f.read())
+    return PublisherCorpus(items, pages)
+
+
+def load_corpus(publisher_classes, articles):
+    """ {publisher class name: PublisherCorpus}, recorded where available """
+    return {cls.__name__: recorded_corpus(cls, articles) or synthetic_corpus(cls, articles)
+            for cls in publisher_classes}
@@ -0,0 +1,59 @@
+"""
+Record feeds and article pages of every publisher into benchmarks/corpus for offline benchmarks:
+
+    python -m benchmarks.record --articles 20
+"""
+import argparse
+import asyncio
+import json
+import os
+
+from benchmarks.corpus import CORPUS_DIR
+from feeds import iter_feed
+from publishers import BasePublisher
+from transport import Transport
+
+
+async def record_publisher(transport, publisher_class, articles):
+    publisher = publisher_class()
+    response = await transport.feeds.request('GET', publisher.rss, timeout=20)
+    content = await response.text()
+    path = os.path.join(CORPUS_DIR, publisher_class.__name__)
+    os.makedirs(path, exist_ok=True)
+    items = []
+    for item in iter_feed(content):
+        if len(items) >= articles:
+            break
+        if not item.link or not item.title or not item.published:
+            continue
+        try:
+            page = await transport.articles.request('GET', item.link, timeout=20)
+            body = await page.read()
+        except Exception as e:
+            print('{}: {} - {}'.format(e.__class__.__name__, publisher.name, item.link))
+            continue
+        with open(os.path.join(path, '{}.html'.format(len(items))), 'wb') as f:
+            f.write(body)
+        items.append({'title': item.title, 'published': item.published, 'summary': item.summary,
+                      'link': item.link})
+    with open(os.path.join(path, 'items.json'), 'w', encoding='utf-8') as f:
+        json.dump(items, f, ensure_ascii=False, indent=1)
+    print('{}: {} articles'.format(publisher.name, len(items)))
+
+
+async def record(loop, articles):
+    # The same client as in production, so that the sites serve the same pages
+    async with Transport(loop) as transport:
+        coros = [record_publisher(transport, subclass, articles) for subclass in BasePublisher.__subclasses__()]
+        for result in await asyncio.gather(*coros, return_exceptions=True):
+            if isinstance(result, Exception):
+                print('{}: {}'.format(result.__class__.__name__, result))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--articles', type=int, default=20, help='articles per publisher')
+    args = arg_parser.parse_args()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(record(loop, args.articles))
+    loop.close()
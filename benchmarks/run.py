@@ -0,0 +1,212 @@
+"""
+Offline end-to-end benchmark: replays the corpus from a local server and reports throughput and latency
+of every stage of the pipeline, storages are replaced by an in-memory writer.
+
+    python -m benchmarks.run --scale 10 --articles 20
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import json
+import tempfile
+import time
+
+import storage
+from archive import page_archive
+from benchmarks.corpus import load_corpus
+from benchmarks.server import CorpusServer, feed_url
+from benchmarks.state import isolate_state
+from entries import Entry
+from extraction import extract, shutdown_pool
+from feeds import iter_feed
+from pipeline import pipeline
+from profiling import profiler
+from publishers import BasePublisher
+from scheduler import scheduler, FEED, ARTICLE
+from transport import Transport
+from settings import MAX_REQUESTS
+from topics import topic_profiles
+
+STAGES = ['feed fetch', 'feed parse', 'title filter', 'download', 'extraction', 'classification', 'save_entry']
+
+
+class Stage():
+    """ Samples of one stage: (items, seconds) per feed or per article """
+
+    def __init__(self, name):
+        self.name = name
+        self.samples = []
+        self.wall = None
+
+    @contextlib.contextmanager
+    def timer(self, items=1):
+        started = time.perf_counter()
+        yield
+        self.add(items, time.perf_counter() - started)
+
+    def add(self, items, seconds):
+        self.samples.append((items, seconds))
+
+    def summary(self):
+        items = sum(n for n, _ in self.samples)
+        latencies = sorted(seconds for _, seconds in self.samples)
+        wall = self.wall if self.wall is not None else sum(latencies)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+
+        return collections.OrderedDict([('stage', self.name), ('items', items), ('seconds', round(wall, 4)),
+                                        ('items_per_sec', round(items / wall, 1) if wall else 0),
+                                        ('p50_ms', round(percentile(0.5), 2)), ('p95_ms', round(percentile(0.95), 2))])
+
+
+class MemoryWriter(storage.BufferedWriter):
+    """ Fake storage, keeps the entries """
+    name = 'Memory'
+
+    def __init__(self, **kwargs):
+        # Publishers wait until their entries are written, a real storage's flush interval would only add idle time
+        kwargs.setdefault('flush_interval', 0.1)
+        super().__init__(**kwargs)
+        self.entries = []
+
+    async def write(self, entries):
+        self.entries.extend(entries)
+
+
+async def fetch(session, stage, url, priority):
+    async with scheduler.slot(url, priority):
+        with stage.timer():
+            response = await session.request('GET', url, timeout=20)
+            return await response.read()
+
+
+async def timed_gather(stage, coros):
+    started = time.perf_counter()
+    results = await asyncio.gather(*coros)
+    stage.wall = time.perf_counter() - started
+    return results
+
+
+def make_publishers(publisher_classes, base, scale):
+    """ scale copies of every publisher, each with its own feed on the local server """
+    publishers = []
+    for copy in range(scale):
+        for publisher_class in publisher_classes:
+            publisher = publisher_class()
+            publisher.rss = feed_url(base, publisher_class.__name__, copy)
+            publisher.name = '{} #{}'.format(publisher_class.name, copy)
+            publishers.append(publisher)
+    return publishers
+
+
+async def run_stages(transport, publishers):
+    stages = collections.OrderedDict((name, Stage(name)) for name in STAGES)
+
+    feeds = await timed_gather(stages['feed fetch'],
+                               [fetch(transport.feeds, stages['feed fetch'], p.rss, FEED) for p in publishers])
+
+    parsed = []
+    for publisher, content in zip(publishers, feeds):
+        content = content.decode(publisher.encoding, errors='replace')
+        started = time.perf_counter()
+        items = [(item, publisher.date_parser.parse(item.published)) for item in iter_feed(content)]
+        stages['feed parse'].add(len(items), time.perf_counter() - started)
+        parsed.append((publisher, items))
+
+    entries = []
+    for publisher, items in parsed:
+        with stages['title filter'].timer(len(items)):
+            matched = [(item, published, topic_profiles.match(item.title)) for item, published in items]
+        entries.extend(Entry(item.link, item.title, published, publisher, topics)
+                       for item, published, topics in matched if topics)
+
+    bodies = await timed_gather(stages['download'],
+                                [fetch(transport.articles, stages['download'], entry.link, ARTICLE)
+                                 for entry in entries])
+
+    async def extract_entry(entry, body):
+        with stages['extraction'].timer():
+            entry.main_text = await extract(body, entry.publisher)
+
+    await timed_gather(stages['extraction'], [extract_entry(entry, body) for entry, body in zip(entries, bodies)])
+
+    for entry in entries:
+        with stages['classification'].timer():
+            entry.define_country()
+
+    writer = MemoryWriter()
+    storage.writers.append(writer)
+    for entry in entries:
+        with stages['save_entry'].timer():
+            await storage.save_entry(entry)
+    await storage.close_storages()
+    return stages, len(writer.entries)
+
+
+async def run_end_to_end(transport, publishers):
+    writer = MemoryWriter()
+    await writer.start()
+    storage.writers.append(writer)
+    started = time.perf_counter()
+    pipeline.start(transport)
+    await asyncio.gather(*[publisher.submit_feed() for publisher in publishers])
+    await pipeline.close()
+    elapsed = time.perf_counter() - started
+    await storage.close_storages()
+    return elapsed, len(writer.entries), pipeline.stats()
+
+
+async def benchmark(loop, scale, articles):
+    publisher_classes = BasePublisher.__subclasses__()
+    corpus = load_corpus(publisher_classes, articles)
+    server = CorpusServer(corpus, {cls.__name__: cls.encoding for cls in publisher_classes})
+    await server.start(loop)
+    # The local server stands in for every site, so per host limits would only measure the pacing
+    scheduler.max_per_host = MAX_REQUESTS
+    scheduler.host_interval = 0
+    try:
+        async with Transport(loop) as transport:
+            stages, stored = await run_stages(transport, make_publishers(publisher_classes, server.base, scale))
+            elapsed, stored_end_to_end, queues = await run_end_to_end(
+                transport, make_publishers(publisher_classes, server.base, scale))
+            connections = transport.connector.stats()
+    finally:
+        await server.stop()
+        shutdown_pool()
+        page_archive.close()
+    return {'scale': scale, 'publishers': len(publisher_classes) * scale, 'articles_per_feed': articles,
+            'stages': [stage.summary() for stage in stages.values()], 'stored': stored,
+            'end_to_end': {'seconds': round(elapsed, 4), 'stored': stored_end_to_end,
+                           'requests': server.requests, 'bytes': server.bytes, 'queues': queues,
+                           'connections': connections}}
+
+
+def print_report(result):
+    print('{} publishers, {} articles per feed'.format(result['publishers'], result['articles_per_feed']))
+    print('{:<16}{:>10}{:>12}{:>14}{:>10}{:>10}'.format('stage', 'items', 'seconds', 'items/sec', 'p50 ms', 'p95 ms'))
+    for row in result['stages']:
+        print('{stage:<16}{items:>10}{seconds:>12}{items_per_sec:>14}{p50_ms:>10}{p95_ms:>10}'.format(**row))
+    end_to_end = result['end_to_end']
+    print('end to end: {seconds} sec, {stored} stored, {requests} requests, {bytes} bytes served'.format(
+        **end_to_end))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--scale', type=int, default=1, help='copies of every feed (x10, x100 ...)')
+    arg_parser.add_argument('--articles', type=int, default=20, help='articles per feed')
+    arg_parser.add_argument('--json', help='also write the results to this file')
+    args = arg_parser.parse_args()
+    with tempfile.TemporaryDirectory() as state_dir:
+        isolate_state(state_dir)
+        loop = asyncio.get_event_loop()
+        result = loop.run_until_complete(benchmark(loop, args.scale, args.articles))
+        loop.close()
+    print_report(result)
+    # Only with PROFILE set
+    profiler.write_reports()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=1)
@@ -0,0 +1,68 @@
+"""
+Local stand-in for the publishers' sites, replays the corpus:
+/feed/<PublisherClass>/<copy> and /article/<PublisherClass>/<copy>/<n>
+"""
+from xml.sax.saxutils import escape
+
+from aiohttp import web
+
+FEED_TEMPLATE = '''<?xml version="1.0" encoding="{encoding}"?>
+<rss version="2.0"><channel><title>{name}</title><link>{base}</link>
+{items}
+</channel></rss>'''
+
+ITEM_TEMPLATE = '''<item><title>{title}</title><link>{link}</link><pubDate>{published}</pubDate>
+<description>{summary}</description></item>'''
+
+
+def article_url(base, publisher_name, copy, n):
+    return '{}/article/{}/{}/{}'.format(base, publisher_name, copy, n)
+
+
+def feed_url(base, publisher_name, copy):
+    return '{}/feed/{}/{}'.format(base, publisher_name, copy)
+
+
+class CorpusServer():
+    def __init__(self, corpus, encodings):
+        self.corpus = corpus
+        self.encodings = encodings
+        self.base = None
+        self.requests = 0
+        self.bytes = 0
+        self._handler = None
+        self._server = None
+
+    async def feed(self, request):
+        name, copy = request.match_info['publisher'], request.match_info['copy']
+        encoding = self.encodings[name]
+        items = '\n'.join(ITEM_TEMPLATE.format(
+            title=escape(item['title']), link=article_url(self.base, name, copy, n),
+            published=item['published'], summary=escape(item.get('summary') or ''))
+            for n, item in enumerate(self.corpus[name].items))
+        body = FEED_TEMPLATE.format(encoding=encoding, name=name, base=self.base, items=items).encode(
+            encoding, errors='replace')
+        return self.respond(body, 'application/rss+xml', encoding)
+
+    async def article(self, request):
+        name = request.match_info['publisher']
+        n = int(request.match_info['n'])
+        return self.respond(self.corpus[name].pages[n], 'text/html', self.encodings[name])
+
+    def respond(self, body, content_type, encoding):
+        self.requests += 1
+        self.bytes += len(body)
+        return web.Response(body=body, headers={'Content-Type': '{}; charset={}'.format(content_type, encoding)})
+
+    async def start(self, loop, host='127.0.0.1', port=0):
+        app = web.Application()
+        app.router.add_get('/feed/{publisher}/{copy}', self.feed)
+        app.router.add_get('/article/{publisher}/{copy}/{n}', self.article)
+        self._handler = app.make_handler()
+        self._server = await loop.create_server(self._handler, host, port)
+        self.base = 'http://{}:{}'.format(host, self._server.sockets[0].getsockname()[1])
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        await self._handler.shutdown()
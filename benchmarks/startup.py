@@ -0,0 +1,99 @@
+"""
+Startup benchmark: import time of main.py and time from process start to the first request, measured in fresh
+processes. Storages are taken from the environment like in a real run, the feed is served locally with a 304.
+
+    python -m benchmarks.startup --runs 5
+"""
+import time
+
+started = time.perf_counter()
+
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+
+NOT_MODIFIED = b'HTTP/1.1 304 Not Modified\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+
+async def first_request(loop, publisher_name):
+    """ Run main.main for one publisher against a local feed, return (import, first request) seconds """
+    import main
+    imported = time.perf_counter()
+    from benchmarks.state import isolate_state
+
+    requested = []
+
+    async def handle(reader, writer):
+        await reader.readline()
+        if not requested:
+            requested.append(time.perf_counter())
+        writer.write(NOT_MODIFIED)
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    publisher_class, = main.select_publishers(names=[publisher_name])
+    publisher_class.rss = 'http://127.0.0.1:{}/rss'.format(server.sockets[0].getsockname()[1])
+    with tempfile.TemporaryDirectory() as state_dir:
+        isolate_state(state_dir)
+        await main.main(loop, [publisher_class])
+    server.close()
+    return imported - started, requested[0] - started
+
+
+def measure(runs, publisher_name):
+    results = []
+    for _ in range(runs):
+        spawned = time.perf_counter()
+        output = subprocess.check_output([sys.executable, '-m', 'benchmarks.startup', '--child', publisher_name])
+        result = json.loads(output.decode().splitlines()[-1])
+        result['process_seconds'] = round(time.perf_counter() - spawned, 4)
+        results.append(result)
+    return {key: {'median': round(statistics.median(result[key] for result in results), 4),
+                  'min': round(min(result[key] for result in results), 4)}
+            for key in ('import_seconds', 'first_request_seconds', 'process_seconds')}
+
+
+def slowest_imports(top):
+    """ Modules with the largest cumulative import time, by python -X importtime """
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                            stderr=subprocess.PIPE, stdout=subprocess.DEVNULL).stderr.decode()
+    imports = []
+    for line in output.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            imports.append((int(parts[1]) / 1e6, parts[2].rstrip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--runs', type=int, default=5, help='fresh processes to measure')
+    arg_parser.add_argument('--publisher', default='ApaAz', help='class name of the publisher to request')
+    arg_parser.add_argument('--top', type=int, default=15, help='slowest imports to list')
+    arg_parser.add_argument('--json', help='also write the results to this file')
+    arg_parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.child:
+        loop = asyncio.get_event_loop()
+        import_seconds, first_request_seconds = loop.run_until_complete(first_request(loop, args.child))
+        loop.close()
+        print(json.dumps({'import_seconds': round(import_seconds, 4),
+                          'first_request_seconds': round(first_request_seconds, 4)}))
+        sys.exit()
+
+    result = {'startup': measure(args.runs, args.publisher), 'imports': slowest_imports(args.top)}
+    print('{:<24}{:>10}{:>10}'.format('', 'median', 'min'))
+    for key, value in result['startup'].items():
+        print('{:<24}{median:>10}{min:>10}'.format(key, **value))
+    print('\nslowest imports (cumulative sec):')
+    for seconds, module in result['imports']:
+        print('{:>10.4f}  {}'.format(seconds, module))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=1)
@@ -0,0 +1,19 @@
+import os
+
+import archive
+import dedup
+import feedstate
+import health
+import history
+from settings import logger_history
+
+
+def isolate_state(path):
+    """ Keep the benchmarks away from the real history, feed state, publisher health and page archive """
+    history.seen_links.path = os.path.join(path, 'harvester.sqlite3')
+    history.history_file = os.path.join(path, 'history.log')
+    feedstate.feed_states.path = os.path.join(path, 'harvester.sqlite3')
+    dedup.near_duplicates.path = os.path.join(path, 'harvester.sqlite3')
+    health.publisher_health.path = os.path.join(path, 'harvester.sqlite3')
+    archive.page_archive.path = os.path.join(path, 'archive')
+    logger_history.disabled = True
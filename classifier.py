@@ -0,0 +1,103 @@
+import bisect
+import collections
+import re
+
+DEFAULT_COUNTRY = 'Другие'
+
+
+class CountryClassifier():
+    """
+    Country detection by keywords.
+
+    All patterns are compiled once: a single regex of all countries tells whether a text mentions any of
+    them at all, and one regex per keyword group, wrapped in a lookahead so that every position of the text
+    is tried, counts its hits. Groups are counted separately because at a given position an alternation matches
+    only one of them, which would hide keywords sharing a prefix with a keyword of another country.
+    A country may be declared by several groups, the order of the groups is what the policies go by.
+    """
+
+    def __init__(self, countries_keywords, policy='last'):
+        self.policy = policy
+        self.countries = []
+        self.groups = []  # (country, regex) per group of keywords, in the declared order
+        alternatives = []
+        for keywords, country in countries_keywords.items():
+            if country not in self.countries:
+                self.countries.append(country)
+            alternative = '|'.join('(?:{})'.format(keyword) for keyword in keywords)
+            alternatives.append(alternative)
+            self.groups.append((country, re.compile('(?=({}))'.format(alternative))))
+        self.regex = re.compile('|'.join('(?:{})'.format(alternative) for alternative in alternatives))
+
+    def scan(self, text):
+        """ Counter of {group index: hits} """
+        hits = collections.Counter()
+        if not self.regex.search(text):
+            return hits
+        for i, (_, regex) in enumerate(self.groups):
+            count = sum(1 for _ in regex.finditer(text))
+            if count:
+                hits[i] = count
+        return hits
+
+    def scan_groups(self, text):
+        """ Hits per group, the text is checked as is and lowercased """
+        hits = self.scan(text)
+        for i, count in self.scan(text.lower()).items():
+            if count > hits[i]:
+                hits[i] = count
+        return hits
+
+    def by_country(self, group_hits):
+        hits = collections.Counter()
+        for i, count in group_hits.items():
+            hits[self.groups[i][0]] += count
+        return hits
+
+    def classify(self, text):
+        """ Return a Counter of {country: hits} """
+        return self.by_country(self.scan_groups(text))
+
+    def classify_many(self, texts):
+        """ Classify a batch of texts with one scan per group and case, return a list of Counters """
+        texts = list(texts)
+        results = [collections.Counter() for _ in texts]
+        for batch in (texts, [text.lower() for text in texts]):
+            hits = [collections.Counter() for _ in texts]
+            starts, position = [], 0
+            for text in batch:
+                starts.append(position)
+                position += len(text) + 1
+            joined = '\n'.join(batch)
+            for group, (_, regex) in enumerate(self.groups):
+                for match in regex.finditer(joined):
+                    i = bisect.bisect_right(starts, match.start()) - 1
+                    # Skip matches which spill over the separator into the next text
+                    if match.end(1) > starts[i] + len(batch[i]):
+                        continue
+                    hits[i][group] += 1
+            for result, text_hits in zip(results, hits):
+                for group, count in text_hits.items():
+                    if count > result[group]:
+                        result[group] = count
+        return [self.by_country(result) for result in results]
+
+    def choose(self, group_hits, policy=None):
+        """
+        Pick one country out of the hits per group (see scan_groups).
+        'last' - the country of the last declared group with hits (legacy behaviour), 'first' - of the first one,
+        'most' - the country with the most hits (ties go to the first declared one).
+        """
+        if not group_hits:
+            return None
+        policy = policy or self.policy
+        matched = sorted(i for i, count in group_hits.items() if count)
+        if policy == 'first':
+            return self.groups[matched[0]][0]
+        if policy == 'most':
+            hits = self.by_country(group_hits)
+            return max((country for country in self.countries if hits.get(country)), key=lambda country: hits[country])
+        return self.groups[matched[-1]][0]
+
+    def define_country(self, text, policy=None):
+        return self.choose(self.scan_groups(text), policy=policy)
@@ -0,0 +1,98 @@
+"""
+Resident alternative to running main.py by cron: one event loop and one http transport for all feeds,
+every publisher is polled on its own interval, adapted to how often its feed gets new entries.
+"""
+import asyncio
+import random
+import signal
+
+from archive import page_archive
+from extraction import shutdown_pool
+from health import publisher_health
+from metrics import metrics, serve_metrics
+from pipeline import pipeline
+from profiling import profiler
+from publishers import BasePublisher
+from settings import (POLL_MIN_INTERVAL, POLL_MAX_INTERVAL, POLL_TARGET_ITEMS, POLL_JITTER, METRICS_PORT,
+                      logger_debug)
+from storage import open_storages, close_storages
+from transport import Transport
+
+
+class PollInterval():
+    """ Keeps a moving average of new entries per second and derives the next delay from it """
+    smoothing = 0.3
+
+    def __init__(self, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL, target_items=POLL_TARGET_ITEMS,
+                 jitter=POLL_JITTER):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_items = target_items
+        self.jitter = jitter
+        self.rate = None
+        self.interval = min_interval
+
+    def update(self, new_items, elapsed):
+        """ Register a poll which found new_items since the previous one, elapsed seconds ago """
+        if elapsed:
+            rate = new_items / elapsed
+            self.rate = rate if self.rate is None else self.smoothing * rate + (1 - self.smoothing) * self.rate
+            if self.rate > 0:
+                self.interval = self.target_items / self.rate
+            else:
+                self.interval *= 2
+            self.interval = min(self.max_interval, max(self.min_interval, self.interval))
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+async def poll(publisher, transport):
+    loop = asyncio.get_event_loop()
+    interval = PollInterval()
+    previous = None
+    # Spread the first polls, so that all feeds are not requested at the same moment
+    await asyncio.sleep(random.uniform(0, interval.min_interval))
+    while True:
+        started = loop.time()
+        try:
+            new_items = await publisher.submit_feed()
+        except Exception as e:
+            logger_debug.error('{}: {}'.format(e.__class__.__name__, publisher.name))
+            new_items = 0
+        publisher_health.persist()
+        # The first poll has nothing to compare with
+        delay = interval.update(new_items, started - previous if previous is not None else None)
+        previous = started
+        logger_debug.info('{}: {} new entries, next poll in {:.0f} sec'.format(publisher.name, new_items, delay))
+        await asyncio.sleep(delay)
+
+
+async def run(loop):
+    await open_storages()
+    metrics_server = await serve_metrics(loop, METRICS_PORT) if METRICS_PORT else None
+    try:
+        async with Transport(loop) as transport:
+            pipeline.start(transport)
+            tasks = [asyncio.ensure_future(poll(subclass(), transport)) for subclass in BasePublisher.__subclasses__()]
+            stop = asyncio.Event()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signum, stop.set)
+            await stop.wait()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await pipeline.close()
+    finally:
+        await close_storages()
+        shutdown_pool()
+        page_archive.close()
+        publisher_health.persist()
+        if metrics_server is not None:
+            metrics_server.close()
+        metrics.export()
+        profiler.write_reports()
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(loop))
+    loop.close()
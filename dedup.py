@@ -0,0 +1,128 @@
+import collections
+import hashlib
+import re
+import time
+
+from settings import NEAR_DUP_DAYS, state_db
+from statedb import connect
+
+WORD_RE = re.compile(r'\w+')
+BITS = 64
+BANDS = 8
+BAND_BITS = BITS // BANDS
+# Must stay below BANDS: fingerprints within BANDS - 1 bits of each other always share a band
+MAX_DISTANCE = 6
+SHINGLE_SIZE = 2
+MIN_SHINGLES = 10
+# Fingerprints older than the window are dropped from the database and the buckets at most this often (sec)
+EXPIRE_INTERVAL = 3600
+
+
+def simhash(text):
+    """ 64 bit SimHash of word 2-shingles, None for texts too short to compare """
+    words = WORD_RE.findall(text.lower())
+    shingles = collections.Counter(' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1))
+    if len(shingles) < MIN_SHINGLES:
+        return None
+    weights = [0] * BITS
+    for shingle, count in shingles.items():
+        h = int.from_bytes(hashlib.md5(shingle.encode('utf-8')).digest()[:8], 'big')
+        for bit in range(BITS):
+            weights[bit] += count if h >> bit & 1 else -count
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def bands(fingerprint):
+    mask = (1 << BAND_BITS) - 1
+    return [(band, fingerprint >> band * BAND_BITS & mask) for band in range(BANDS)]
+
+
+class NearDuplicates():
+    """
+    SimHash index of the stored articles of the last days, with LSH banding for lookups.
+    Kept in memory and persisted in SQLite, so the window survives restarts and is shared by shards.
+    The window rolls: lookups ignore older fingerprints and they are expired every EXPIRE_INTERVAL.
+    """
+
+    def __init__(self, path, days):
+        self.path = path
+        self.window = days * 24 * 3600
+        self.buckets = collections.defaultdict(list)  # (band, value) -> [(fingerprint, link, seen_at)]
+        self.last_rowid = 0
+        self.expired_at = 0
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = connect(self.path)
+            with self._conn:
+                self._conn.execute('CREATE TABLE IF NOT EXISTS near_duplicates ('
+                                   'link TEXT PRIMARY KEY, fingerprint INTEGER NOT NULL, seen_at REAL NOT NULL)')
+        return self._conn
+
+    def expire(self, now=None):
+        """ Forget the fingerprints which have left the window, in the database and in the buckets """
+        now = now or time.time()
+        oldest = now - self.window
+        with self.conn:
+            self.conn.execute('DELETE FROM near_duplicates WHERE seen_at < ?', (oldest,))
+        for band in list(self.buckets):
+            kept = [item for item in self.buckets[band] if item[2] >= oldest]
+            if kept:
+                self.buckets[band] = kept
+            else:
+                del self.buckets[band]
+        self.expired_at = now
+
+    def refresh(self):
+        """ Load the fingerprints added since the last call, also by other processes sharing the database """
+        now = time.time()
+        if now - self.expired_at >= EXPIRE_INTERVAL:
+            self.expire(now)
+        rows = self.conn.execute('SELECT rowid, link, fingerprint, seen_at FROM near_duplicates WHERE rowid > ? '
+                                 'ORDER BY rowid', (self.last_rowid,)).fetchall()
+        for rowid, link, fingerprint, seen_at in rows:
+            self.index(link, fingerprint % (1 << BITS), seen_at)
+            self.last_rowid = rowid
+
+    def index(self, link, fingerprint, seen_at):
+        for band in bands(fingerprint):
+            self.buckets[band].append((fingerprint, link, seen_at))
+
+    def find(self, fingerprint):
+        """ Link of an already stored article within MAX_DISTANCE bits, or None """
+        self.refresh()
+        oldest = time.time() - self.window
+        for band in bands(fingerprint):
+            for candidate, link, seen_at in self.buckets.get(band, ()):
+                if seen_at >= oldest and bin(candidate ^ fingerprint).count('1') <= MAX_DISTANCE:
+                    return link
+        return None
+
+    def add(self, link, fingerprint):
+        # SQLite integers are signed 64 bit
+        signed = fingerprint - (1 << BITS) if fingerprint >= 1 << BITS - 1 else fingerprint
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO near_duplicates (link, fingerprint, seen_at) VALUES (?, ?, ?)',
+                              (link, signed, time.time()))
+        self.refresh()
+
+    def check(self, link, text):
+        """ Return the canonical link if the text is a near duplicate, otherwise remember it and return None """
+        fingerprint = simhash(text)
+        if fingerprint is None:
+            return None
+        canonical = self.find(fingerprint)
+        if canonical is None or canonical == link:
+            self.add(link, fingerprint)
+            return None
+        return canonical
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+near_duplicates = NearDuplicates(state_db, NEAR_DUP_DAYS)
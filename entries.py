@@ -1,66 +1,207 @@
-import re
+import asyncio
+import time
 
-import async_timeout
-from bs4 import BeautifulSoup
+from archive import page_archive
+from classifier import DEFAULT_COUNTRY
+from extraction import extract, strip_text, detect_charset
+from health import publisher_health, BreakerOpen
+from history import seen_links
+from metrics import metrics
+from scheduler import scheduler, ARTICLE
+from settings import ARTICLE_MAX_BYTES, logger_history, logger_debug
+from storage import save_entry, rejection_reason
+from topics import topic_profiles
 
-from settings import COUNTRIES_KEYWORDS, logger_history, logger_debug
-from storage import save_entry
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class DownloadRejected(Exception):
+    """ The response is not an html page or it is too large """
+
+
+async def read_html(response, max_bytes=ARTICLE_MAX_BYTES):
+    """
+    Read the body in chunks, give up on non-html responses and on bodies larger than max_bytes.
+    Error statuses raise, an error page is a failed request and not an article.
+    """
+    if response.status >= 400:
+        await response.release()
+        response.raise_for_status()
+    content_type = response.headers.get('Content-Type', '').lower()
+    if content_type and not any(html_type in content_type for html_type in HTML_CONTENT_TYPES):
+        response.close()
+        raise DownloadRejected('Not html: {}'.format(content_type))
+    content_length = response.headers.get('Content-Length')
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        response.close()
+        raise DownloadRejected('Too large: {} bytes'.format(content_length))
+    chunks, size = [], 0
+    while True:
+        chunk = await response.content.read(DOWNLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            response.close()
+            raise DownloadRejected('Too large: over {} bytes'.format(max_bytes))
+        chunks.append(chunk)
+    return b''.join(chunks)
 
 
 class Entry():
-    def __init__(self, link, title, publish_dt, publisher):
+    """
+    A selected article on its way through the pipeline stages, each stage returns False if the entry
+    should not go on. The raw html is dropped as soon as the text is extracted.
+    The article is downloaded once for all the topics its title matched, every topic defines its own country.
+    """
+    __slots__ = ('link', 'title', 'publish_dt', 'publisher', 'topics', 'main_text', 'country', 'countries',
+                 'duplicate_of', 'prefilter_skip', 'body', 'encoding', 'done')
+
+    def __init__(self, link, title, publish_dt, publisher, topics=None):
         self.link = link
         self.title = title
         self.publish_dt = publish_dt
         self.publisher = publisher
+        # Names of the matched topic profiles, all of them if not given
+        self.topics = list(topics) if topics is not None else topic_profiles.names
         self.main_text = ''
-        self.country = 'Другие'
+        # Country of the first topic which has one, and of every topic
+        self.country = DEFAULT_COUNTRY
+        self.countries = {}
+        self.duplicate_of = None
+        self.prefilter_skip = False
+        self.body = None
+        self.encoding = None
+        # Result for the publisher: True - done with, False - should be retried later
+        self.done = None
 
-    async def download_entry(self, session):
-        print('Start downloading {}'.format(self.link))
+    def finish(self, ok):
+        self.body = None
+        if self.done is not None and not self.done.done():
+            self.done.set_result(ok)
+
+    async def download_entry(self, transport):
+        """ Download, parse and save the article in one go, return False if it should be retried later """
+        self.done = asyncio.Future()
+        if await self.download(transport) and await self.extract() and await self.classify():
+            await self.store()
+        return self.done.result()
+
+    async def download(self, transport):
+        logger_debug.debug('Start downloading {}'.format(self.link))
+        name = self.publisher.name
         try:
-            response = await session.request('GET', self.link, timeout=20)
-            print('Finish downloading {}'.format(self.link))
-            body = await response.read()
-            body = body.decode(encoding=self.publisher.encoding)
+            async with scheduler.slot(self.link, ARTICLE):
+                # The breaker may have opened while waiting for the slot
+                if not publisher_health.allow(name):
+                    raise BreakerOpen(name)
+                started = time.monotonic()
+                with metrics.timer('article_download_seconds', name):
+                    response = await transport.articles.request('GET', self.link,
+                                                     timeout=publisher_health.timeout(name, 'article'))
+                    body = await read_html(response)
+            publisher_health.success(name, 'article', time.monotonic() - started)
+        except BreakerOpen:
+            metrics.inc('entries', name, 'breaker_open')
+            self.finish(False)
+            return False
+        except DownloadRejected as e:
+            # Would be rejected again next time, so the link is remembered as done
+            metrics.inc('entries', name, 'download_rejected')
+            logger_debug.warning('{}: {} - {}'.format(e.__class__.__name__, e, self.link))
+            seen_links.add(self.link)
+            self.finish(True)
+            return False
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger_debug.error('{}: {}'.format(e.__class__.__name__, self.publisher.name))
-            return
-        else:
-            soup = BeautifulSoup(body, "html.parser")
-            for script in soup.findAll('script'):  # Delete all js scripts from soup
-                script.decompose()
-            for style in soup.findAll('style'):  # Delete all css styles from soup
-                style.decompose()
-            try:
-                self.main_text = self.publisher.parse_body(soup) or ''
-            except AttributeError as e:
-                logger_debug.error('{}: Parse Error: {}'.format(e.__class__.__name__, self.link))
-                return
-            self.strip_main_text()
-            print(self.title)
-            print(self.link)
-            print(self.main_text)
-            self.define_country()
-            await save_entry(self)
+            metrics.inc('errors', name, e.__class__.__name__)
+            logger_debug.error('{}: {}'.format(e.__class__.__name__, name))
+            publisher_health.failure(name)
+            self.finish(False)
+            return False
+        logger_debug.debug('Finish downloading {}'.format(self.link))
+        metrics.inc('article_bytes', name, value=len(body))
+        self.body = body
+        self.encoding = detect_charset(response.headers.get('Content-Type'), body, self.publisher.encoding)
+        try:
+            await page_archive.add_async(self.link, body, self.publisher.__class__.__name__, self.encoding,
+                                         self.title, self.publish_dt)
+        except OSError as e:
+            # The article is still processed, only a later re-extraction would miss it
+            metrics.inc('errors', name, 'ArchiveError')
+            logger_debug.error('{}: archive - {}'.format(e.__class__.__name__, e))
+        return True
+
+    async def extract(self):
+        name = self.publisher.name
+        body, self.body = self.body, None
+        try:
+            with metrics.timer('parse_seconds', name):
+                self.main_text = await extract(body, self.publisher, self.encoding)
+        except AttributeError as e:
+            metrics.inc('errors', name, 'ParseError')
+            logger_debug.error('{}: Parse Error: {}'.format(e.__class__.__name__, self.link))
+            self.finish(False)
+            return False
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.inc('errors', name, e.__class__.__name__)
+            logger_debug.error('{}: {}'.format(e.__class__.__name__, name))
+            self.finish(False)
+            return False
+        return True
+
+    async def classify(self):
+        self.define_country()
+        return True
+
+    async def store(self):
+        name = self.publisher.name
+        stored, written = await save_entry(self)
+        metrics.inc('entries', name, 'stored' if stored else 'dropped')
+        for topic in stored:
+            metrics.inc('topic_stored', name, topic)
+        if not stored:
+            metrics.inc('downloads_wasted', name, rejection_reason(self) or 'near_duplicate')
+        if self.prefilter_skip:
+            # Downloaded only to check the pre-download guess, which would have skipped it
+            metrics.inc('prefilter', name, 'wrong_skip' if stored else 'right_skip')
+        logger_debug.debug('{} | {} | {} | {} chars | {}'.format(
+            name, self.country, self.title, len(self.main_text), 'stored ' + ','.join(stored) if stored else 'dropped'))
+        # The store stage does not wait for the batch, the entry is done with once it has been written
+        written.add_done_callback(lambda future: self.acknowledge(future.result()))
+        return True
+
+    def acknowledge(self, written):
+        """ Mark the link as downloaded if all its writes succeeded, otherwise it is retried next run """
+        if written:
+            seen_links.add(self.link)
             logger_history.warning(self.link)
+        else:
+            metrics.inc('entries', self.publisher.name, 'write_failed')
+        self.finish(written)
 
     def define_country(self):
         """
-        First try to define country by title, then (if not failed to define) by main_text
+        For every topic first try to define country by title, then (if not failed to define) by main_text
         """
-        self.define_country_by_keywords(self.title)
-        if self.country == 'Другие':
-            # Only first part of the article is relevant for defining country
-            self.define_country_by_keywords(self.main_text[:350])
-
-    def define_country_by_keywords(self, text):
-        for keywords in COUNTRIES_KEYWORDS.items():
-            for keyword in keywords[0]:
-                p = re.compile(keyword)
-                if p.search(text) or p.search(text.lower()):
-                    self.country = keywords[1]
+        self.countries = {topic: topic_profiles[topic].define_country(self.title, self.main_text) or DEFAULT_COUNTRY
+                          for topic in self.topics}
+        self.country = next((self.countries[topic] for topic in self.topics
+                             if self.countries[topic] != DEFAULT_COUNTRY), DEFAULT_COUNTRY)
+
+    def for_topic(self, topic):
+        """ The entry as stored for one of its topics, with the country of that topic """
+        routed = Entry(self.link, self.title, self.publish_dt, self.publisher, [topic])
+        routed.main_text = self.main_text
+        routed.duplicate_of = self.duplicate_of
+        routed.country = self.countries.get(topic, DEFAULT_COUNTRY)
+        routed.countries = {topic: routed.country}
+        return routed
 
     def strip_main_text(self):
         """ Remove empty lists and trailing spaces """
-        self.main_text = "\n".join([line.strip() for line in self.main_text.split('\n') if line.strip()])
+        self.main_text = strip_text(self.main_text)
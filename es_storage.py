@@ -0,0 +1,36 @@
+from aioelasticsearch import Elasticsearch
+
+from settings import ES_HOST, ES_PORT, logger_debug
+from storage import BufferedWriter, entry_document
+
+
+class ElasticsearchWriter(BufferedWriter):
+    """ Indexes documents into the target index with _bulk, the link based _id makes reruns overwrite them """
+    name = 'Elasticsearch'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.index = self.target or 'harvester'
+        self.client = None
+
+    async def setup(self):
+        # Created here, inside the running loop
+        self.client = Elasticsearch([{'host': ES_HOST, 'port': ES_PORT}])
+
+    async def teardown(self):
+        await self.client.close()
+
+    async def write(self, entries):
+        body = []
+        for entry in entries:
+            document = entry_document(entry)
+            body.append({'index': {'_index': self.index, '_type': entry.country, '_id': document.pop('_id')}})
+            body.append(document)
+        result = await self.client.bulk(body=body)
+        if result.get('errors'):
+            # Items come in the order of the actions, the failed entries are retried next run
+            failed = [(entry, item) for entry, item in zip(entries, result['items']) if item['index'].get('error')]
+            logger_debug.error('Elasticsearch: {} of {} documents failed, first error: {}'.format(
+                len(failed), len(entries), failed[0][1]['index']['error']))
+            return [entry for entry, _ in failed]
+        return None
@@ -0,0 +1,136 @@
+import asyncio
+import codecs
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+from profiling import profiler
+from settings import EXTRACT_WORKERS, HTML_PARSER
+
+CHARSET_RE = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.I)
+META_CHARSET_RE = re.compile(br'<meta[^>]+charset\s*=\s*["\']?([\w.:-]+)', re.I)
+META_SEARCH_BYTES = 4096
+
+_pool = None
+_publishers = {}
+
+
+def get_publisher(publisher_name):
+    """ Publisher instance by its class name, the worker processes only receive names """
+    if not _publishers:
+        from publishers import BasePublisher
+        for subclass in BasePublisher.__subclasses__():
+            _publishers[subclass.__name__] = subclass()
+    return _publishers[publisher_name]
+
+
+def valid_charset(charset):
+    try:
+        return codecs.lookup(charset).name
+    except (LookupError, TypeError):
+        return None
+
+
+def detect_charset(content_type, body, default):
+    """ Charset from the Content-Type header, then from the meta tags of the page, then the default """
+    match = CHARSET_RE.search(content_type or '')
+    if match and valid_charset(match.group(1)):
+        return match.group(1)
+    match = META_CHARSET_RE.search(body[:META_SEARCH_BYTES])
+    if match:
+        charset = match.group(1).decode('ascii')
+        if valid_charset(charset):
+            return charset
+    return default
+
+
+def strip_text(text):
+    """ Remove empty lists and trailing spaces """
+    return "\n".join([line.strip() for line in text.split('\n') if line.strip()])
+
+
+def attribute_matcher(values):
+    """
+    Match an attribute by its whole value or by one of its space separated tokens (as bs4 does with classes).
+    The strainer sees raw attribute strings, so it can not be given the values as is.
+    """
+    values = [values] if isinstance(values, str) else list(values)
+
+    def matches(value):
+        if value is None:
+            return False
+        if isinstance(value, list):
+            value = ' '.join(value)
+        return value in values or any(token in values for token in value.split())
+    return matches
+
+
+def container_strainer(container):
+    """ SoupStrainer for a publisher's content_container, which is (tag or list of tags, {attribute: value(s)}) """
+    tags, attrs = container
+    return SoupStrainer(tags, {key: attribute_matcher(value) for key, value in attrs.items()})
+
+
+def make_soup(text, parse_only=None):
+    soup = BeautifulSoup(text, HTML_PARSER, parse_only=parse_only)
+    for script in soup.findAll('script'):  # Delete all js scripts from soup
+        script.decompose()
+    for style in soup.findAll('style'):  # Delete all css styles from soup
+        style.decompose()
+    return soup
+
+
+def extract_text(body, publisher_name, encoding):
+    """
+    Decode and parse the downloaded page, return the article text.
+    If the publisher declares its content container, only that subtree is parsed first;
+    the whole page is parsed if the container is missing or nothing could be extracted from it.
+    """
+    publisher = get_publisher(publisher_name)
+    try:
+        text = body.decode(encoding=encoding)
+    except UnicodeDecodeError:
+        # The declared charset may be wrong, the publisher's one has been checked by hand
+        if encoding == publisher.encoding:
+            raise
+        text = body.decode(encoding=publisher.encoding)
+    if publisher.content_container:
+        soup = make_soup(text, parse_only=container_strainer(publisher.content_container))
+        if soup.find() is not None:
+            try:
+                with profiler.profile('parse_body.' + publisher_name):
+                    main_text = publisher.parse_body(soup)
+            except AttributeError:
+                main_text = None
+            if main_text:
+                return strip_text(main_text)
+    soup = make_soup(text)
+    with profiler.profile('parse_body.' + publisher_name):
+        return strip_text(publisher.parse_body(soup) or '')
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS)
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+async def extract(body, publisher, encoding=None):
+    """
+    Run extract_text in the process pool if EXTRACT_WORKERS is set, otherwise in the event loop thread.
+    Only the raw bytes and the publisher name cross the process boundary.
+    """
+    args = (body, publisher.__class__.__name__, encoding or publisher.encoding)
+    # Profiles are only collected in this process
+    if EXTRACT_WORKERS and not profiler.enabled:
+        return await asyncio.get_event_loop().run_in_executor(get_pool(), extract_text, *args)
+    return extract_text(*args)
@@ -0,0 +1,107 @@
+import calendar
+import collections
+from datetime import datetime, timezone
+from xml.etree.ElementTree import XMLPullParser, ParseError
+
+FeedItem = collections.namedtuple('FeedItem', ['link', 'title', 'published', 'summary'])
+
+ITEM_TAGS = {'item', 'entry'}
+DATE_TAGS = ('pubDate', 'published', 'updated', 'date')
+SUMMARY_TAGS = ('description', 'summary')
+CHUNK_SIZE = 16 * 1024
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def iter_xml_items(content):
+    """
+    Stream items of a plain RSS 2.0 / RSS 1.0 / Atom feed with an incremental XML parser.
+    Items are yielded as soon as they are parsed, so the consumer may stop early.
+    """
+    xml_parser = XMLPullParser(events=('end',))
+    for i in range(0, len(content), CHUNK_SIZE):
+        xml_parser.feed(content[i:i + CHUNK_SIZE])
+        for _, element in xml_parser.read_events():
+            if local_name(element.tag) not in ITEM_TAGS:
+                continue
+            fields = {}
+            for child in element:
+                name = local_name(child.tag)
+                if name == 'link':
+                    # Atom keeps the link in href, several links may be given
+                    link = child.get('href') if child.get('href') is not None else child.text
+                    if child.get('rel', 'alternate') == 'alternate' or 'link' not in fields:
+                        fields['link'] = link and link.strip()
+                elif name not in fields:
+                    fields[name] = child.text and child.text.strip()
+            element.clear()
+            yield FeedItem(fields.get('link'), fields.get('title'),
+                           next((fields[tag] for tag in DATE_TAGS if fields.get(tag)), None),
+                           next((fields[tag] for tag in SUMMARY_TAGS if fields.get(tag)), None))
+    xml_parser.close()
+
+
+def iter_feedparser_items(content):
+    # Only needed for broken feeds, so it is not imported at startup
+    import feedparser
+    for entry in feedparser.parse(content)['entries']:
+        yield FeedItem(entry.get('link'), entry.get('title'), entry.get('published') or entry.get('updated'),
+                       entry.get('summary'))
+
+
+def iter_feed(content):
+    """ Fast path for well-formed feeds, feedparser for everything else (and for the rest of a broken feed) """
+    yielded = set()
+    try:
+        for item in iter_xml_items(content):
+            yielded.add(item.link)
+            yield item
+        return
+    except ParseError:
+        pass
+    for item in iter_feedparser_items(content):
+        if item.link not in yielded:
+            yield item
+
+
+class FeedDateParser():
+    """ Parses pubDates with strptime, remembering the format which worked last time; dateutil is the fallback """
+    formats = ['%a, %d %b %Y %H:%M:%S %z', '%a, %d %b %Y %H:%M:%S GMT', '%a, %d %b %Y %H:%M:%S UTC',
+               '%d %b %Y %H:%M:%S %z', '%a, %d %b %Y %H:%M %z', '%Y-%m-%dT%H:%M:%S%z', '%Y-%m-%dT%H:%M:%S.%f%z',
+               '%Y-%m-%d %H:%M:%S']
+    # Not %Z, which also accepts the local zone names and would leave e.g. MSK stamped as UTC
+    utc_suffixes = (' GMT', ' UTC')
+
+    def __init__(self):
+        self.format = None
+
+    def strptime(self, value, date_format):
+        dt = datetime.strptime(value, date_format)
+        if date_format.endswith(self.utc_suffixes):
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt
+
+    def parse(self, value):
+        if self.format:
+            try:
+                return self.strptime(value, self.format)
+            except ValueError:
+                pass
+        for date_format in self.formats:
+            try:
+                dt = self.strptime(value, date_format)
+            except ValueError:
+                continue
+            self.format = date_format
+            return dt
+        from dateutil import parser
+        return parser.parse(value)
+
+
+def timestamp(dt):
+    """ Comparable timestamp of a feed date, naive dates are taken as UTC """
+    if dt.tzinfo is None:
+        return calendar.timegm(dt.timetuple())
+    return dt.timestamp()
@@ -0,0 +1,76 @@
+import collections
+import hashlib
+import time
+
+from settings import state_db
+from statedb import connect
+
+FeedState = collections.namedtuple('FeedState', ['etag', 'last_modified', 'content_hash'])
+
+EMPTY_STATE = FeedState(None, None, None)
+
+
+def content_hash(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def conditional_headers(state):
+    """ Headers for a conditional GET of the feed """
+    headers = {}
+    if state.etag:
+        headers['If-None-Match'] = state.etag
+    if state.last_modified:
+        headers['If-Modified-Since'] = state.last_modified
+    return headers
+
+
+class FeedStates():
+    """
+    Per publisher validators of the last processed feed (ETag, Last-Modified and a hash of the content)
+    and the publish time of the newest processed entry
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = connect(self.path)
+            with self._conn:
+                self._conn.execute('CREATE TABLE IF NOT EXISTS feed_state ('
+                                   'publisher TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, '
+                                   'content_hash TEXT, updated_at REAL NOT NULL)')
+                self._conn.execute('CREATE TABLE IF NOT EXISTS feed_watermark ('
+                                   'publisher TEXT PRIMARY KEY, published REAL NOT NULL)')
+        return self._conn
+
+    def get(self, publisher):
+        row = self.conn.execute('SELECT etag, last_modified, content_hash FROM feed_state WHERE publisher = ?',
+                                (publisher,)).fetchone()
+        return FeedState(*row) if row else EMPTY_STATE
+
+    def save(self, publisher, state):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO feed_state '
+                              '(publisher, etag, last_modified, content_hash, updated_at) VALUES (?, ?, ?, ?, ?)',
+                              (publisher,) + tuple(state) + (time.time(),))
+
+    def get_watermark(self, publisher):
+        """ Timestamp of the newest processed entry of the feed """
+        row = self.conn.execute('SELECT published FROM feed_watermark WHERE publisher = ?', (publisher,)).fetchone()
+        return row[0] if row else None
+
+    def save_watermark(self, publisher, published):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO feed_watermark (publisher, published) VALUES (?, ?)',
+                              (publisher, published))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+feed_states = FeedStates(state_db)
@@ -0,0 +1,153 @@
+import collections
+import json
+import time
+
+from settings import (BREAKER_THRESHOLD, BREAKER_BACKOFF, BREAKER_MAX_BACKOFF, FEED_READ_TIMEOUT, ARTICLE_READ_TIMEOUT,
+                      MIN_TIMEOUT, TIMEOUT_FACTOR, state_db)
+from statedb import connect
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Latencies kept per publisher and kind of request ('feed' or 'article')
+LATENCY_WINDOW = 50
+# Fewer samples do not say enough to shorten the timeout
+MIN_SAMPLES = 5
+# The timeout of a kind of request never exceeds the read timeout configured for it
+READ_TIMEOUTS = {'feed': FEED_READ_TIMEOUT, 'article': ARTICLE_READ_TIMEOUT}
+# A probe has timed out by then, whatever its kind
+PROBE_TIMEOUT = max(READ_TIMEOUTS.values())
+
+
+class BreakerOpen(Exception):
+    """ Requests to the publisher are skipped for now """
+
+
+class Health():
+    """ Breaker state and recent latencies of one publisher """
+
+    def __init__(self, failures=0, state=CLOSED, retry_at=0, latencies=None):
+        self.failures = failures
+        self.state = state
+        self.retry_at = retry_at
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=LATENCY_WINDOW))
+        for kind, samples in (latencies or {}).items():
+            self.latencies[kind].extend(samples)
+
+    def percentile(self, kind, q):
+        samples = sorted(self.latencies.get(kind, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+class PublisherHealth():
+    """
+    Per publisher circuit breaker, kept in memory and persisted once per run (or poll of the daemon).
+
+    closed - requests go through; after BREAKER_THRESHOLD failures in a row it opens.
+    open - requests are skipped until the backoff (doubled with every failure) has passed, then it is half open.
+    half_open - one probe goes through: success closes the breaker, failure opens it again. A probe which
+    reports neither (e.g. cancelled) is replaced by another one after PROBE_TIMEOUT.
+    """
+
+    def __init__(self, path, threshold=BREAKER_THRESHOLD, backoff=BREAKER_BACKOFF, max_backoff=BREAKER_MAX_BACKOFF):
+        self.path = path
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.publishers = {}
+        self.changed = set()
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = connect(self.path)
+            with self._conn:
+                self._conn.execute('CREATE TABLE IF NOT EXISTS publisher_health ('
+                                   'publisher TEXT PRIMARY KEY, failures INTEGER NOT NULL, state TEXT NOT NULL, '
+                                   'retry_at REAL NOT NULL, latencies TEXT NOT NULL, updated_at REAL NOT NULL)')
+        return self._conn
+
+    def get(self, publisher):
+        if publisher not in self.publishers:
+            row = self.conn.execute('SELECT failures, state, retry_at, latencies FROM publisher_health '
+                                    'WHERE publisher = ?', (publisher,)).fetchone()
+            self.publishers[publisher] = Health(row[0], row[1], row[2], json.loads(row[3])) if row else Health()
+        return self.publishers[publisher]
+
+    def persist(self):
+        """ Write the changed publishers in one transaction """
+        if not self.changed:
+            return
+        now = time.time()
+        rows = []
+        for publisher in self.changed:
+            health = self.publishers[publisher]
+            latencies = {kind: list(samples) for kind, samples in health.latencies.items()}
+            rows.append((publisher, health.failures, health.state, health.retry_at, json.dumps(latencies), now))
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO publisher_health '
+                                  '(publisher, failures, state, retry_at, latencies, updated_at) '
+                                  'VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self.changed.clear()
+
+    def allow(self, publisher):
+        """ Whether a request to the publisher may be made now, in half open state only the probe may """
+        health = self.get(publisher)
+        if health.state == CLOSED:
+            return True
+        now = time.time()
+        if now < health.retry_at:
+            return False
+        # This request is the probe, no other one goes through until it reports or PROBE_TIMEOUT has passed
+        health.state = HALF_OPEN
+        health.retry_at = now + PROBE_TIMEOUT
+        self.changed.add(publisher)
+        return True
+
+    def timeout(self, publisher, kind):
+        """
+        Timeout of a request of the kind derived from the observed latency, clamped into MIN_TIMEOUT and
+        the read timeout of the kind; slow and new publishers keep the read timeout
+        """
+        health = self.get(publisher)
+        read_timeout = READ_TIMEOUTS[kind]
+        if len(health.latencies.get(kind, ())) < MIN_SAMPLES:
+            return read_timeout
+        return min(read_timeout, max(MIN_TIMEOUT, TIMEOUT_FACTOR * health.percentile(kind, 0.95)))
+
+    def success(self, publisher, kind, seconds):
+        health = self.get(publisher)
+        health.latencies[kind].append(round(seconds, 3))
+        health.failures = 0
+        health.state = CLOSED
+        self.changed.add(publisher)
+
+    def failure(self, publisher):
+        """ Register a failed request, return True if the breaker is open now """
+        health = self.get(publisher)
+        health.failures += 1
+        if health.state == HALF_OPEN or health.failures >= self.threshold:
+            health.state = OPEN
+            extra = max(0, health.failures - self.threshold)
+            health.retry_at = time.time() + min(self.max_backoff, self.backoff * 2 ** min(extra, 32))
+        self.changed.add(publisher)
+        return health.state == OPEN
+
+    def stats(self):
+        return {publisher: {'state': health.state, 'failures': health.failures,
+                            'feed_p95': health.percentile('feed', 0.95),
+                            'article_p95': health.percentile('article', 0.95)}
+                for publisher, health in self.publishers.items()}
+
+    def close(self):
+        self.persist()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+publisher_health = PublisherHealth(state_db)
@@ -0,0 +1,97 @@
+import os
+import time
+
+from settings import HISTORY_TTL_DAYS, history_file, state_db
+from statedb import connect
+
+# Links older than the ttl are deleted this often (sec), so that a long running process does not keep them
+EXPIRE_INTERVAL = 3600
+
+
+class SeenLinks():
+    """
+    Persistent set of already downloaded links.
+
+    Links are kept in SQLite (primary key lookups) with an in-memory set in front of it, so a link
+    which has been checked once is never looked up on disk again. Links older than ttl are not taken as seen
+    and are expired every EXPIRE_INTERVAL, in the database and in memory.
+    """
+
+    def __init__(self, path, ttl_days):
+        self.path = path
+        self.ttl = ttl_days * 24 * 3600
+        self.known = {}  # link -> seen_at
+        self.expired_at = 0
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = connect(self.path)
+            with self._conn:
+                self._conn.execute('CREATE TABLE IF NOT EXISTS seen_links ('
+                                   'link TEXT PRIMARY KEY, seen_at REAL NOT NULL)')
+                self._conn.execute('CREATE INDEX IF NOT EXISTS seen_links_seen_at ON seen_links (seen_at)')
+            if not self._conn.execute('SELECT 1 FROM seen_links LIMIT 1').fetchone():
+                self.import_history_log()
+        return self._conn
+
+    def import_history_log(self):
+        """ Take over the links from the old history.log (and its backup) """
+        links = []
+        for path in (history_file + '.1', history_file):
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding='utf-8-sig', errors='replace') as f:
+                for line in f:
+                    link = line.rsplit(' | ', 1)[-1].strip()
+                    if link:
+                        links.append(link)
+        self.add_many(links)
+
+    def expire(self, now=None):
+        now = now or time.time()
+        oldest = now - self.ttl
+        with self.conn:
+            self.conn.execute('DELETE FROM seen_links WHERE seen_at < ?', (oldest,))
+        self.known = {link: seen_at for link, seen_at in self.known.items() if seen_at >= oldest}
+        self.expired_at = now
+
+    def contains_many(self, links):
+        """ Return the set of links which have already been seen """
+        now = time.time()
+        if now - self.expired_at >= EXPIRE_INTERVAL:
+            self.expire(now)
+        oldest = now - self.ttl
+        seen = {link for link in links if self.known.get(link, 0) >= oldest}
+        unknown = list({link for link in links if link not in seen})
+        # Stay below SQLite's limit of host parameters per statement
+        for i in range(0, len(unknown), 500):
+            chunk = unknown[i:i + 500]
+            rows = self.conn.execute('SELECT link, seen_at FROM seen_links WHERE seen_at >= ? AND link IN ({})'.format(
+                ','.join('?' * len(chunk))), [oldest] + chunk).fetchall()
+            for link, seen_at in rows:
+                self.known[link] = seen_at
+                seen.add(link)
+        return seen
+
+    def contains(self, link):
+        return bool(self.contains_many([link]))
+
+    def add_many(self, links):
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO seen_links (link, seen_at) VALUES (?, ?)',
+                                  [(link, now) for link in links])
+        self.known.update((link, now) for link in links)
+
+    def add(self, link):
+        self.add_many([link])
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+seen_links = SeenLinks(state_db, HISTORY_TTL_DAYS)
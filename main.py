@@ -1,21 +1,138 @@
+import argparse
 import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import zlib
 
-import aiohttp
-
+from archive import page_archive
+from extraction import shutdown_pool
+from health import publisher_health
+from metrics import metrics
+from pipeline import pipeline
+from profiling import profiler
 from publishers import BasePublisher
-from settings import logger_debug
+from scheduler import scheduler
+from settings import RUN_DEADLINE, logger_debug
+from storage import open_storages, close_storages
+from topics import topic_profiles
+from transport import Transport
+
+
+def shard_of(publisher_class, shards):
+    """ 1-based shard of the publisher, stable across processes and machines """
+    return zlib.crc32(publisher_class.__name__.encode('utf-8')) % shards + 1
+
+
+def select_publishers(shard=None, names=None):
+    """ Publisher classes of the shard, optionally only those given by class name or name """
+    subclasses = BasePublisher.__subclasses__()
+    if names:
+        known = {subclass.__name__ for subclass in subclasses} | {subclass.name for subclass in subclasses}
+        unknown = set(names) - known
+        if unknown:
+            raise ValueError('Unknown publishers: {}'.format(', '.join(sorted(unknown))))
+        subclasses = [subclass for subclass in subclasses if subclass.__name__ in names or subclass.name in names]
+    if shard:
+        index, shards = shard
+        subclasses = [subclass for subclass in subclasses if shard_of(subclass, shards) == index]
+    return subclasses
+
+
+def parse_shard(value):
+    try:
+        index, shards = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected K/N, e.g. 2/8')
+    if not 1 <= index <= shards:
+        raise argparse.ArgumentTypeError('K must be between 1 and N')
+    return index, shards
+
+
+async def main(loop, publisher_classes, deadline=RUN_DEADLINE):
+    await open_storages()
+    try:
+        async with Transport(loop) as transport:
+            pipeline.start(transport)
+            publishers = [subclass() for subclass in publisher_classes]
+            tasks = {asyncio.ensure_future(publisher.submit_feed()): publisher
+                     for publisher in publishers}
+            done, pending = await asyncio.wait(tasks, timeout=deadline or None) if tasks else (set(), set())
+            # Stragglers lose their unfinished downloads, which are retried next run; stored entries are kept
+            for task in pending:
+                task.cancel()
+                metrics.inc('deadline_cancelled', tasks[task].name)
+                logger_debug.warning('Run deadline, cancelled - {}'.format(tasks[task].name))
+            await asyncio.gather(*pending, return_exceptions=True)
+            await pipeline.close()
+            for task in done:
+                if task.exception():
+                    e = task.exception()
+                    logger_debug.error('{}: {}'.format(e.__class__.__name__, e))
+            logger_debug.info('Requests: {}'.format(scheduler.stats()))
+            logger_debug.info('Pipeline: {}'.format(pipeline.stats()))
+            logger_debug.info('Health: {}'.format(publisher_health.stats()))
+    finally:
+        await close_storages()
+        shutdown_pool()
+        page_archive.close()
+        publisher_health.persist()
+
 
+def run_workers(workers, publishers=None, profile=False, topics=None):
+    """
+    Coordinator: run every shard in its own process and merge their metrics into one run summary.
+    Shards share the seen links, feed state and near-duplicate index through harvester.sqlite3.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        dumps = [os.path.join(tmp, 'shard-{}.json'.format(index)) for index in range(1, workers + 1)]
+        extra = ['--publishers', ','.join(publishers)] if publishers else []
+        if topics:
+            extra += ['--topics', ','.join(topics)]
+        if profile:
+            extra.append('--profile')
+        processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                       '--shard', '{}/{}'.format(index, workers), '--metrics-dump', dump] + extra)
+                     for index, dump in enumerate(dumps, 1)]
+        for index, process in enumerate(processes, 1):
+            if process.wait():
+                logger_debug.error('Shard {}/{} exited with {}'.format(index, workers, process.returncode))
+        for dump in dumps:
+            if os.path.exists(dump):
+                metrics.merge(dump)
+    metrics.export()
 
-async def main(loop):
-    async with aiohttp.ClientSession(loop=loop) as session:
-        subclasses = BasePublisher.__subclasses__()
-        coros = [subclass().filter_links_from_rss(session) for subclass in subclasses]
-        try:
-            await asyncio.gather(*coros)
-        except Exception as e:
-            logger_debug.error('{}: {}'.format(e.__class__.__name__, e))
 
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Download, filter and store the news of all publishers')
+    arg_parser.add_argument('--shard', type=parse_shard, help='K/N - only process the K-th of N shards of publishers')
+    arg_parser.add_argument('--workers', type=int, help='run N shards in parallel processes and merge their metrics')
+    arg_parser.add_argument('--publishers', type=lambda value: [name.strip() for name in value.split(',')],
+                            help='comma separated class names (or names) of the publishers to run, e.g. ApaAz,Camto')
+    arg_parser.add_argument('--topics', type=lambda value: [name.strip() for name in value.split(',')],
+                            help='comma separated topic profiles to evaluate (like TOPICS), e.g. militar,economics')
+    arg_parser.add_argument('--profile', action='store_true',
+                            help='profile pipeline stages and parse_body of every publisher (like PROFILE=1)')
+    arg_parser.add_argument('--metrics-dump', help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+    try:
+        publisher_classes = select_publishers(args.shard, args.publishers)
+        if args.topics:
+            topic_profiles.select(args.topics)
+    except ValueError as e:
+        arg_parser.error(str(e))
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(main(loop))
-loop.close()
\ No newline at end of file
+    if args.workers:
+        run_workers(args.workers, args.publishers, args.profile, args.topics)
+    else:
+        if args.profile and not profiler.enabled:
+            profiler.enable()
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(main(loop, publisher_classes))
+        loop.close()
+        if args.metrics_dump:
+            metrics.dump(args.metrics_dump)
+        else:
+            metrics.export()
+        profiler.write_reports()
@@ -0,0 +1,52 @@
+import os
+import re
+
+
+class KeywordMatcher():
+    """
+    Topic filter for entry titles.
+
+    Keywords and stop words are compiled into two alternations once per process. The keyword file
+    is re-read only when its mtime changes, so it still can be tuned without restarting.
+    """
+
+    def __init__(self, path, stop_words):
+        self.path = path
+        self.stop_words = list(stop_words)
+        self.mtime = None
+        self.keywords = []
+        self.keywords_re = None
+        self.stop_words_re = self.compile(self.stop_words)
+
+    @staticmethod
+    def compile(patterns):
+        if not patterns:
+            return None
+        return re.compile('|'.join('(?:{})'.format(pattern) for pattern in patterns))
+
+    def reload(self):
+        """ Re-read the keyword file if it has been changed since the last load """
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.mtime and self.keywords_re is not None:
+            return
+        keywords = []
+        if mtime is not None:
+            with open(self.path, encoding='utf-8-sig') as f:
+                keywords = [l.strip() for l in f if l.strip()]
+        self.mtime = mtime
+        self.keywords = keywords
+        self.keywords_re = self.compile(keywords)
+
+    @staticmethod
+    def search(pattern, title):
+        return pattern is not None and bool(pattern.search(title) or pattern.search(title.lower()))
+
+    def matches(self, title):
+        """ True if the title matches any theme keyword and none of the stop words """
+        self.reload()
+        if not self.search(self.keywords_re, title):
+            return False
+        return not self.search(self.stop_words_re, title)
@@ -0,0 +1,187 @@
+import collections
+import contextlib
+import json
+import random
+import time
+
+from settings import METRICS_JSON_FILE, METRICS_PROM_FILE, METRICS_RESERVOIR_SIZE
+
+PREFIX = 'harvester_'
+
+
+class Timing():
+    """
+    Exact count, sum and max of a timing plus a uniform random sample of its values (reservoir sampling)
+    for the quantiles, so that a long-running daemon keeps a bounded number of samples.
+    """
+
+    def __init__(self, size=METRICS_RESERVOIR_SIZE):
+        self.size = size
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.samples = []
+
+    def add(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        if len(self.samples) < self.size:
+            self.samples.append(seconds)
+        else:
+            i = random.randrange(self.count)
+            if i < self.size:
+                self.samples[i] = seconds
+
+    def merge(self, other):
+        """ Add another timing, its samples are taken in proportion to its count """
+        count = self.count + other.count
+        if not count:
+            return
+        if len(self.samples) + len(other.samples) > self.size:
+            own = round(self.size * self.count / count)
+            self.samples = (random.sample(self.samples, min(own, len(self.samples))) +
+                            random.sample(other.samples, min(self.size - own, len(other.samples))))
+        else:
+            self.samples = self.samples + other.samples
+        self.count = count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def to_json(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max, 'samples': self.samples}
+
+    @classmethod
+    def from_json(cls, data):
+        timing = cls()
+        timing.count, timing.sum, timing.max, timing.samples = data['count'], data['sum'], data['max'], data['samples']
+        return timing
+
+
+class Metrics():
+    """
+    Counters and timings of a run, labelled by publisher (or by storage for writes).
+    Exported as a Prometheus text file and as a JSON summary.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = collections.Counter()  # (name, publisher, label) -> value
+        self.timings = collections.defaultdict(Timing)  # (name, publisher) -> Timing
+
+    def inc(self, name, publisher, label='', value=1):
+        self.counters[(name, publisher, label)] += value
+
+    def observe(self, name, publisher, seconds):
+        self.timings[(name, publisher)].add(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, publisher):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, publisher, time.perf_counter() - started)
+
+    @staticmethod
+    def describe(timing):
+        samples = sorted(timing.samples)
+        return collections.OrderedDict([
+            ('count', timing.count),
+            ('sum', round(timing.sum, 4)),
+            ('p50', round(samples[len(samples) // 2], 4)),
+            ('p95', round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 4)),
+            ('max', round(timing.max, 4)),
+        ])
+
+    def summary(self):
+        """ Per publisher numbers and totals of the run """
+        publishers = collections.defaultdict(lambda: {'counters': {}, 'timings': {}})
+        totals = {'counters': collections.Counter(), 'timings': {}}
+        all_timings = collections.defaultdict(Timing)
+        for (name, publisher, label), value in self.counters.items():
+            key = '{}.{}'.format(name, label) if label else name
+            publishers[publisher]['counters'][key] = value
+            totals['counters'][key] += value
+        for (name, publisher), timing in self.timings.items():
+            publishers[publisher]['timings'][name] = self.describe(timing)
+            all_timings[name].merge(timing)
+        for name, timing in all_timings.items():
+            totals['timings'][name] = self.describe(timing)
+        return {'started': self.started, 'duration': round(time.time() - self.started, 3),
+                'totals': totals, 'publishers': publishers}
+
+    @staticmethod
+    def escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def prometheus(self):
+        """ Prometheus text exposition format """
+        lines = []
+        for name in sorted({key[0] for key in self.counters}):
+            lines.append('# TYPE {}{}_total counter'.format(PREFIX, name))
+            for (counter, publisher, label), value in sorted(self.counters.items()):
+                if counter != name:
+                    continue
+                labels = 'publisher="{}"'.format(self.escape(publisher))
+                if label:
+                    labels += ',label="{}"'.format(self.escape(label))
+                lines.append('{}{}_total{{{}}} {}'.format(PREFIX, name, labels, value))
+        for name in sorted({key[0] for key in self.timings}):
+            lines.append('# TYPE {}{} summary'.format(PREFIX, name))
+            for (timing_name, publisher), timing in sorted(self.timings.items(), key=lambda item: item[0]):
+                if timing_name != name:
+                    continue
+                described = self.describe(timing)
+                publisher = self.escape(publisher)
+                for quantile in ('p50', 'p95'):
+                    lines.append('{}{}{{publisher="{}",quantile="0.{}"}} {}'.format(
+                        PREFIX, name, publisher, quantile[1:], described[quantile]))
+                lines.append('{}{}_sum{{publisher="{}"}} {}'.format(PREFIX, name, publisher, described['sum']))
+                lines.append('{}{}_count{{publisher="{}"}} {}'.format(PREFIX, name, publisher, described['count']))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """ Raw counters and timings, to be merged by the coordinator of shards """
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'started': self.started,
+                       'counters': [list(key) + [value] for key, value in self.counters.items()],
+                       'timings': [list(key) + [timing.to_json()] for key, timing in self.timings.items()]},
+                      f, ensure_ascii=False)
+
+    def merge(self, path):
+        """ Add the numbers dumped by another process """
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        self.started = min(self.started, data['started'])
+        for name, publisher, label, value in data['counters']:
+            self.counters[(name, publisher, label)] += value
+        for name, publisher, timing in data['timings']:
+            self.timings[(name, publisher)].merge(Timing.from_json(timing))
+
+    def export(self, prom_file=METRICS_PROM_FILE, json_file=METRICS_JSON_FILE):
+        if prom_file:
+            with open(prom_file, 'w', encoding='utf-8') as f:
+                f.write(self.prometheus())
+        if json_file:
+            with open(json_file, 'w', encoding='utf-8') as f:
+                json.dump(self.summary(), f, ensure_ascii=False, indent=1)
+
+
+metrics = Metrics()
+
+
+async def serve_metrics(loop, port):
+    """ /metrics and /metrics.json endpoints for the daemon """
+    from aiohttp import web
+
+    async def prometheus(request):
+        return web.Response(text=metrics.prometheus(), content_type='text/plain')
+
+    async def summary(request):
+        return web.Response(text=json.dumps(metrics.summary(), ensure_ascii=False), content_type='application/json')
+
+    app = web.Application()
+    app.router.add_get('/metrics', prometheus)
+    app.router.add_get('/metrics.json', summary)
+    return await loop.create_server(app.make_handler(), '0.0.0.0', port)
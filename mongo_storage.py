@@ -0,0 +1,42 @@
+import motor.motor_asyncio
+from pymongo import UpdateOne
+
+from settings import MONGO_HOST, MONGO_PORT, MONGO_DB_NAME, logger_debug
+from storage import BufferedWriter, entry_document
+from topics import topic_profiles
+
+
+class MongoWriter(BufferedWriter):
+    """ Upserts documents by a link based _id with bulk_write into the target database, one collection per country """
+    name = 'MongoDB'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.client = None
+        self.db = None
+
+    async def setup(self):
+        # Created here, inside the running loop
+        self.client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_HOST, MONGO_PORT)
+        self.db = self.client[self.target or MONGO_DB_NAME]
+        topics = self.topics or topic_profiles.names
+        for country in set().union(*(topic_profiles[topic].countries for topic in topics)):
+            try:
+                await self.db[country].create_index('link', unique=True)
+            except Exception as e:
+                logger_debug.error('{}: MongoDB index on {} - {}'.format(e.__class__.__name__, country, e))
+
+    async def teardown(self):
+        self.client.close()
+
+    async def write(self, entries):
+        requests = {}
+        for entry in entries:
+            document = entry_document(entry)
+            # An upsert takes the _id from the filter
+            document_id = document.pop('_id')
+            operator = '$set' if self.overwrite else '$setOnInsert'
+            requests.setdefault(entry.country, []).append(
+                UpdateOne({'_id': document_id}, {operator: document}, upsert=True))
+        for country, country_requests in requests.items():
+            await self.db[country].bulk_write(country_requests, ordered=False)
@@ -0,0 +1,201 @@
+import datetime
+
+from aiopg.sa import create_engine
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert as pg_insert, TSVECTOR
+from slugify import slugify
+
+from settings import PG_DB, PG_USER, PG_PASSWORD, PG_POOL_SIZE, PG_TS_CONFIG, PG_PARTITION_BY_MONTH, logger_debug
+from storage import BufferedWriter
+
+metadata = sa.MetaData()
+
+NEWS_TABLE = 'app_news'
+
+
+def news_table(name=NEWS_TABLE):
+    """ News table of a topic, every topic profile has its own """
+    if name in metadata.tables:
+        return metadata.tables[name]
+    return sa.Table(name, metadata,
+                    sa.Column('id', sa.Integer, primary_key=True),
+                    sa.Column('rss', sa.String(255)),
+                    sa.Column('title', sa.Text()),
+                    sa.Column('body', sa.Text()),
+                    sa.Column('pub_time', sa.DateTime()),
+                    sa.Column('published_at', sa.DateTime(timezone=True)),
+                    sa.Column('country_id', sa.String(255)),
+                    sa.Column('link', sa.Text(), unique=True),
+                    sa.Column('download_time', sa.DateTime(), default=datetime.datetime.now),
+                    sa.Column('duplicate_of', sa.Text()),
+                    sa.Column('search_vector', TSVECTOR())
+                    )
+
+
+news_tbl = news_table()
+
+countries_tbl = sa.Table('app_countries', metadata,
+                         sa.Column('name', sa.String(255), primary_key=True),
+                         sa.Column('slug', sa.String(255))
+                         )
+
+# Columns replaced when an article is stored again with overwrite
+OVERWRITTEN_COLUMNS = ('title', 'body', 'country_id', 'duplicate_of', 'published_at', 'search_vector')
+
+
+async def connect(maxsize=PG_POOL_SIZE):
+    return await create_engine(user=PG_USER,
+                               database=PG_DB,
+                               host='127.0.0.1',
+                               password=PG_PASSWORD,
+                               minsize=1,
+                               maxsize=maxsize)
+
+
+async def create_tables(engine, partitioned=PG_PARTITION_BY_MONTH, table=NEWS_TABLE):
+    """ Create the tables and the search indexes, return True if the news table is partitioned by month """
+    async with engine.acquire() as conn:
+        if partitioned:
+            # The partition key has to be part of every unique constraint
+            await conn.execute('''CREATE TABLE IF NOT EXISTS {} (
+                                      id SERIAL,
+                                      rss VARCHAR(255),
+                                      title VARCHAR,
+                                      body VARCHAR,
+                                      pub_time VARCHAR(255),
+                                      published_at TIMESTAMPTZ NOT NULL,
+                                      download_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                                      country_id VARCHAR(255),
+                                      link VARCHAR,
+                                      duplicate_of VARCHAR,
+                                      search_vector TSVECTOR,
+                                      UNIQUE (link, published_at)
+                                      ) PARTITION BY RANGE (published_at)'''.format(table))
+        else:
+            await conn.execute('''CREATE TABLE IF NOT EXISTS {} (
+                                      id SERIAL PRIMARY KEY,
+                                      rss VARCHAR(255),
+                                      title VARCHAR,
+                                      body VARCHAR,
+                                      pub_time VARCHAR(255),
+                                      download_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                                      country_id VARCHAR(255),
+                                      link VARCHAR,
+                                      duplicate_of VARCHAR,
+                                      UNIQUE (link)
+                                      )'''.format(table))
+        await conn.execute('ALTER TABLE {} ADD COLUMN IF NOT EXISTS duplicate_of VARCHAR'.format(table))
+        await conn.execute('ALTER TABLE {} ADD COLUMN IF NOT EXISTS published_at TIMESTAMPTZ'.format(table))
+        await conn.execute('ALTER TABLE {} ADD COLUMN IF NOT EXISTS search_vector TSVECTOR'.format(table))
+        await conn.execute('CREATE INDEX IF NOT EXISTS {0}_search_idx ON {0} USING GIN (search_vector)'.format(table))
+        await conn.execute('CREATE INDEX IF NOT EXISTS {0}_published_idx ON {0} (published_at DESC)'.format(table))
+        await conn.execute('CREATE INDEX IF NOT EXISTS {0}_country_published_idx '
+                           'ON {0} (country_id, published_at DESC)'.format(table))
+        await conn.execute('''CREATE TABLE IF NOT EXISTS app_countries (
+                                  name VARCHAR(255) PRIMARY KEY,
+                                  slug VARCHAR(255)
+                                  )''')
+        result = await conn.execute("SELECT relkind FROM pg_class WHERE relname = '{}'".format(table))
+        is_partitioned = await result.scalar() == 'p'
+    if partitioned and not is_partitioned:
+        logger_debug.error('PostgreSQL: {} already exists and is not partitioned, it has to be migrated by hand'.format(
+            table))
+    return is_partitioned
+
+
+async def backfill(engine, table=NEWS_TABLE):
+    """ Fill published_at and search_vector of the rows stored before they existed """
+    news = news_table(table)
+    async with engine.acquire() as conn:
+        await conn.execute("UPDATE {} SET published_at = pub_time::timestamptz "
+                           "WHERE published_at IS NULL AND pub_time IS NOT NULL".format(table))
+        await conn.execute(news.update().where(news.c.search_vector.is_(None)).values(
+            search_vector=search_vector(news.c.title, news.c.body)))
+
+
+def ts_config():
+    return sa.literal_column("'{}'::regconfig".format(PG_TS_CONFIG))
+
+
+def search_vector(title, body):
+    """ tsvector of an article, title words weigh more """
+    return sa.func.setweight(sa.func.to_tsvector(ts_config(), sa.func.coalesce(title, '')), 'A').op('||')(
+        sa.func.setweight(sa.func.to_tsvector(ts_config(), sa.func.coalesce(body, '')), 'B'))
+
+
+def published_at(publish_dt):
+    # Naive feed dates are taken as UTC, like everywhere else
+    if publish_dt.tzinfo is None:
+        return publish_dt.replace(tzinfo=datetime.timezone.utc)
+    return publish_dt
+
+
+def month_partition(published, table=NEWS_TABLE):
+    """ Name and bounds of the partition of the table holding the time """
+    published = published.astimezone(datetime.timezone.utc)
+    start = datetime.datetime(published.year, published.month, 1, tzinfo=datetime.timezone.utc)
+    end = datetime.datetime(published.year + published.month // 12, published.month % 12 + 1, 1,
+                            tzinfo=datetime.timezone.utc)
+    return '{}_y{:04d}m{:02d}'.format(table, published.year, published.month), start, end
+
+
+class PostgresWriter(BufferedWriter):
+    """
+    Shares one connection pool, inserts news with multi-row INSERT ... ON CONFLICT DO NOTHING into the news table
+    of its target. The search vector is computed by PostgreSQL in the same statement.
+    """
+    name = 'PostgreSQL'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.table = news_table(self.target or NEWS_TABLE)
+        self.engine = None
+        self.countries = set()
+        self.partitioned = False
+        self.partitions = set()
+
+    async def setup(self):
+        self.engine = await connect()
+        self.partitioned = await create_tables(self.engine, table=self.table.name)
+        async with self.engine.acquire() as conn:
+            result = await conn.execute(sa.select([countries_tbl.c.name]))
+            self.countries.update(row.name for row in await result.fetchall())
+
+    async def teardown(self):
+        self.engine.close()
+        await self.engine.wait_closed()
+
+    async def create_partitions(self, conn, times):
+        for name, start, end in {month_partition(published, self.table.name) for published in times}:
+            if name not in self.partitions:
+                await conn.execute("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} "
+                                   "FOR VALUES FROM ('{}') TO ('{}')".format(name, self.table.name, start.isoformat(),
+                                                                             end.isoformat()))
+                self.partitions.add(name)
+
+    async def write(self, entries):
+        new_countries = {entry.country for entry in entries} - self.countries
+        news = {}
+        for entry in entries:
+            news.setdefault(entry.link, dict(rss=entry.publisher.name, title=entry.title, body=entry.main_text,
+                                             pub_time=entry.publish_dt, published_at=published_at(entry.publish_dt),
+                                             country_id=entry.country, link=entry.link,
+                                             download_time=datetime.datetime.now(), duplicate_of=entry.duplicate_of,
+                                             search_vector=search_vector(entry.title, entry.main_text)))
+        conflict_columns = ['link', 'published_at'] if self.partitioned else ['link']
+        async with self.engine.acquire() as conn:
+            if new_countries:
+                await conn.execute(
+                    pg_insert(countries_tbl).values([dict(name=country, slug=slugify(country))
+                                                     for country in new_countries]).on_conflict_do_nothing())
+                self.countries.update(new_countries)
+            if self.partitioned:
+                await self.create_partitions(conn, [row['published_at'] for row in news.values()])
+            insert = pg_insert(self.table).values(list(news.values()))
+            if self.overwrite:
+                insert = insert.on_conflict_do_update(
+                    index_elements=conflict_columns, set_={column: insert.excluded[column]
+                                                           for column in OVERWRITTEN_COLUMNS})
+            else:
+                insert = insert.on_conflict_do_nothing(index_elements=conflict_columns)
+            await conn.execute(insert)
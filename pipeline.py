@@ -0,0 +1,173 @@
+import asyncio
+import collections
+
+from metrics import metrics
+from profiling import profiler
+from scheduler import scheduler, host_of
+from settings import (PIPELINE_FEED_FETCHERS, PIPELINE_FILTERS, PIPELINE_DOWNLOADERS, PIPELINE_EXTRACTORS,
+                      PIPELINE_CLASSIFIERS, PIPELINE_STORERS, PIPELINE_QUEUE_SIZE, logger_debug)
+
+
+class HostQueue():
+    """
+    Bounded download queue with a FIFO per host. get() only hands out entries of hosts with fewer than
+    max_per_host downloads in progress, so a burst of one host does not take all the download workers while
+    the entries of other hosts wait behind it. The hosts take turns.
+    """
+
+    def __init__(self, maxsize, max_per_host):
+        self.maxsize = maxsize
+        self.max_per_host = max_per_host
+        self.hosts = collections.OrderedDict()  # host -> deque of entries
+        self.active = collections.Counter()  # host -> entries being downloaded
+        self.size = 0
+        self.changed = asyncio.Condition()
+
+    def qsize(self):
+        return self.size
+
+    def empty(self):
+        return not self.size
+
+    def ready_host(self):
+        for host in self.hosts:
+            if self.active[host] < self.max_per_host:
+                return host
+        return None
+
+    def pop(self, host):
+        entries = self.hosts.pop(host)
+        entry = entries.popleft()
+        if entries:
+            # Back to the end of the line
+            self.hosts[host] = entries
+        self.size -= 1
+        return entry
+
+    async def put(self, entry):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.size < self.maxsize)
+            self.hosts.setdefault(host_of(entry.link), collections.deque()).append(entry)
+            self.size += 1
+            self.changed.notify_all()
+
+    async def get(self):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.ready_host() is not None)
+            host = self.ready_host()
+            self.active[host] += 1
+            entry = self.pop(host)
+            self.changed.notify_all()
+            return entry
+
+    def get_nowait(self):
+        return self.pop(next(iter(self.hosts)))
+
+    async def release(self, entry):
+        """ The download of an entry taken with get() is over """
+        async with self.changed:
+            host = host_of(entry.link)
+            self.active[host] -= 1
+            if self.active[host] <= 0:
+                del self.active[host]
+            self.changed.notify_all()
+
+    def task_done(self):
+        pass
+
+
+class Pipeline():
+    """
+    Feeds flow feed -> filter, the entries selected by the filter flow download -> extract -> classify -> store,
+    all through bounded queues with their own workers. A full queue blocks the stage in front of it, so a slow
+    storage holds back the downloads and the feeds which fill them instead of piling up pages in memory.
+    What waits for the results (a feed waits for its entries to be stored) waits outside of the stages.
+    """
+    stages = ('feed', 'filter', 'download', 'extract', 'classify', 'store')
+    following = {'feed': 'filter', 'filter': None, 'download': 'extract', 'extract': 'classify',
+                 'classify': 'store', 'store': None}
+
+    def __init__(self, feed_fetchers=PIPELINE_FEED_FETCHERS, filters=PIPELINE_FILTERS,
+                 downloaders=PIPELINE_DOWNLOADERS, extractors=PIPELINE_EXTRACTORS, classifiers=PIPELINE_CLASSIFIERS,
+                 storers=PIPELINE_STORERS, queue_size=PIPELINE_QUEUE_SIZE):
+        self.workers = dict(zip(self.stages, (feed_fetchers, filters, downloaders, extractors, classifiers, storers)))
+        self.queue_size = queue_size
+        self.queues = {}
+        self.max_depth = {}
+        self.tasks = []
+        self.waiting = set()
+
+    def start(self, transport):
+        """ Start the workers, should be called inside the running loop """
+        self.queues = {stage: asyncio.Queue(maxsize=self.queue_size) for stage in self.stages}
+        self.queues['download'] = HostQueue(self.queue_size, scheduler.max_per_host)
+        self.max_depth = dict.fromkeys(self.stages, 0)
+        steps = {'feed': lambda job: job.fetch(transport), 'filter': lambda job: job.filter(),
+                 'download': lambda entry: entry.download(transport), 'extract': lambda entry: entry.extract(),
+                 'classify': lambda entry: entry.classify(), 'store': lambda entry: entry.store()}
+        for stage in self.stages:
+            for _ in range(self.workers[stage]):
+                self.tasks.append(asyncio.ensure_future(self.work(stage, steps[stage], self.following[stage])))
+
+    async def work(self, stage, step, following):
+        inbox = self.queues[stage]
+        while True:
+            item = await inbox.get()
+            try:
+                try:
+                    go_on = await profiler.profile_coroutine('stage.' + stage, step(item))
+                finally:
+                    if stage == 'download':
+                        await inbox.release(item)
+                # Waiting for room in the next queue is where close() usually finds a worker
+                if go_on and following:
+                    await self.put(following, item)
+            except asyncio.CancelledError:
+                item.finish(False)
+                raise
+            except Exception as e:
+                # Stages handle their expected errors, but the publisher must get its answer anyway
+                metrics.inc('errors', item.publisher.name, e.__class__.__name__)
+                logger_debug.error('{}: {} stage - {}'.format(e.__class__.__name__, stage, item.link))
+                item.finish(False)
+            inbox.task_done()
+
+    async def put(self, stage, item):
+        queue = self.queues[stage]
+        await queue.put(item)
+        self.max_depth[stage] = max(self.max_depth[stage], queue.qsize())
+
+    async def submit(self, item, stage='download'):
+        """
+        Queue a feed job (stage 'feed') or a selected entry, waits while the queue is full;
+        return the future of its result
+        """
+        item.done = asyncio.Future()
+        await self.put(stage, item)
+        return item.done
+
+    def track(self, coro):
+        """ Run a coroutine which waits for results of the stages, close() waits for it """
+        task = asyncio.ensure_future(coro)
+        self.waiting.add(task)
+        task.add_done_callback(self.waiting.discard)
+        return task
+
+    def stats(self):
+        return {stage: {'workers': self.workers[stage], 'queued': queue.qsize(), 'max_queued': self.max_depth[stage]}
+                for stage, queue in self.queues.items()}
+
+    async def close(self):
+        """ Stop the workers, entries which did not get through are retried next run """
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        for queue in self.queues.values():
+            while not queue.empty():
+                queue.get_nowait().finish(False)
+        # The feeds save their state once their entries have got an answer
+        await asyncio.gather(*self.waiting, return_exceptions=True)
+
+
+pipeline = Pipeline()
@@ -0,0 +1,165 @@
+import collections
+import cProfile
+import io
+import os
+import pstats
+import re
+import time
+import tracemalloc
+
+from settings import PROFILE, PROFILE_DIR, PROFILE_TOP, PROFILE_SAMPLE_EVERY, logger_debug
+
+
+class NullContext():
+    """ What profile() returns when profiling is off, costs one call """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_CONTEXT = NullContext()
+
+
+class Section():
+    def __init__(self, profiler, key):
+        self.profiler = profiler
+        self.key = key
+
+    def __enter__(self):
+        self.profiler.enter(self.key)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler.exit()
+        return False
+
+
+class ProfiledCoroutine():
+    """
+    Awaits a coroutine with its key profiled only while the coroutine itself runs, so that
+    the other tasks which run while it is suspended do not end up in its profile
+    """
+
+    def __init__(self, profiler, key, coro):
+        self.profiler = profiler
+        self.key = key
+        self.coro = coro
+
+    def __await__(self):
+        value, error = None, None
+        # A call is the whole coroutine, a sampled call has its allocations compared around every slice
+        sampled = self.profiler.count(self.key)
+        while True:
+            self.profiler.enter(self.key, sampled)
+            try:
+                future = self.coro.throw(error) if error is not None else self.coro.send(value)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self.profiler.exit()
+            try:
+                value, error = (yield future), None
+            except BaseException as e:
+                value, error = None, e
+
+
+class Profiler():
+    """
+    Opt-in cProfile and tracemalloc profiles by key (a pipeline stage or a publisher's parse_body).
+    Only one cProfile profile can be active, so a nested key pauses the outer one: a stage's profile
+    does not contain the parse_body calls profiled on their own. Allocations are compared before and after
+    every PROFILE_SAMPLE_EVERY-th section of a key, snapshots are too expensive to take every time.
+    """
+
+    def __init__(self, top=PROFILE_TOP, sample_every=PROFILE_SAMPLE_EVERY):
+        self.top = top
+        self.sample_every = sample_every
+        self.enabled = False
+        self.started = None
+        self.profiles = {}
+        self.calls = collections.Counter()
+        self.allocations = collections.defaultdict(collections.Counter)  # key -> {line: bytes}
+        self.stack = []  # (key, profile, snapshot before or None)
+
+    def enable(self):
+        self.enabled = True
+        self.started = time.time()
+        tracemalloc.start()
+
+    @staticmethod
+    def snapshot():
+        # Without the allocations of the profiler itself
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                                          tracemalloc.Filter(False, __file__)])
+
+    def profile(self, key):
+        """ with profiler.profile(key): ... """
+        return Section(self, key) if self.enabled else NULL_CONTEXT
+
+    def profile_coroutine(self, key, coro):
+        """ await profiler.profile_coroutine(key, coro) """
+        return ProfiledCoroutine(self, key, coro) if self.enabled else coro
+
+    def count(self, key):
+        """ Count a call of the key, return whether its allocations are sampled """
+        self.calls[key] += 1
+        return self.calls[key] % self.sample_every == 1 or self.sample_every == 1
+
+    def enter(self, key, sampled=None):
+        if self.stack:
+            self.stack[-1][1].disable()
+        if sampled is None:
+            sampled = self.count(key)
+        snapshot = self.snapshot() if sampled else None
+        profile = self.profiles.setdefault(key, cProfile.Profile())
+        self.stack.append((key, profile, snapshot))
+        profile.enable()
+
+    def exit(self):
+        key, profile, snapshot = self.stack.pop()
+        profile.disable()
+        if snapshot is not None:
+            for stat in self.snapshot().compare_to(snapshot, 'lineno'):
+                if stat.size_diff > 0:
+                    frame = stat.traceback[0]
+                    self.allocations[key]['{}:{}'.format(frame.filename, frame.lineno)] += stat.size_diff
+        if self.stack:
+            self.stack[-1][1].enable()
+
+    def write_reports(self, path=PROFILE_DIR):
+        """ <key>.prof (pstats dump) and <key>.txt per key, allocations.txt for all keys and the whole run """
+        if not self.enabled:
+            return None
+        # Shards of a run write their own directories
+        run_dir = os.path.join(path, '{}-{}'.format(
+            time.strftime('run-%Y%m%d-%H%M%S', time.localtime(self.started)), os.getpid()))
+        os.makedirs(run_dir, exist_ok=True)
+        for key, profile in sorted(self.profiles.items()):
+            name = re.sub(r'[^\w.-]', '_', key)
+            profile.dump_stats(os.path.join(run_dir, name + '.prof'))
+            report = io.StringIO()
+            report.write('{} - {} calls\n'.format(key, self.calls[key]))
+            pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(self.top)
+            with open(os.path.join(run_dir, name + '.txt'), 'w', encoding='utf-8') as f:
+                f.write(report.getvalue())
+        with open(os.path.join(run_dir, 'allocations.txt'), 'w', encoding='utf-8') as f:
+            for key, lines in sorted(self.allocations.items()):
+                f.write('{} - sampled {} of {} calls\n'.format(
+                    key, (self.calls[key] + self.sample_every - 1) // self.sample_every, self.calls[key]))
+                for line, size in lines.most_common(self.top):
+                    f.write('{:>12.1f} KiB  {}\n'.format(size / 1024, line))
+                f.write('\n')
+            current, peak = tracemalloc.get_traced_memory()
+            f.write('run - {:.1f} MiB traced now, {:.1f} MiB peak\n'.format(current / 2 ** 20, peak / 2 ** 20))
+            for stat in self.snapshot().statistics('lineno')[:self.top]:
+                f.write('{:>12.1f} KiB  {}\n'.format(stat.size / 1024, stat.traceback[0]))
+        logger_debug.info('Profiles written to {}'.format(run_dir))
+        return run_dir
+
+
+profiler = Profiler()
+if PROFILE:
+    profiler.enable()
@@ -1,15 +1,68 @@
-import re
 from datetime import timedelta
 import asyncio
-
-import aiohttp
-import async_timeout
-from dateutil import parser
-import aiofiles
-import feedparser
+import re
+import time
 
 from entries import Entry
-from settings import STOP_WORDS, history_file, keyword_file, CURRENT_TIMEZONE, logger_debug
+from feeds import iter_feed, FeedDateParser, timestamp
+from feedstate import feed_states, FeedState, conditional_headers, content_hash
+from health import publisher_health
+from history import seen_links
+from metrics import metrics
+from pipeline import pipeline
+from scheduler import scheduler, FEED
+from settings import PREFILTER_MODE, FEED_RETRIES, RETRY_DELAY, logger_debug
+from topics import topic_profiles
+
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+# The rest of a feed is not read after this many entries in a row older than the watermark
+OLD_ENTRIES_IN_A_ROW = 5
+
+
+class FeedJob():
+    """
+    A publisher's feed on its way through the feed stages: fetch, then filter, which submits the selected
+    entries to the download stage. Waiting for the entries and saving the feed state is done outside
+    of the stages, so that the feed workers do not wait for the downloads.
+    """
+    __slots__ = ('publisher', 'link', 'new_state', 'content', 'done')
+
+    def __init__(self, publisher):
+        self.publisher = publisher
+        self.link = publisher.rss
+        self.new_state = None
+        self.content = None
+        # Result for the caller: the number of new links
+        self.done = None
+
+    def finish(self, new_links):
+        self.content = None
+        if self.done is not None and not self.done.done():
+            self.done.set_result(new_links or 0)
+
+    async def fetch(self, transport):
+        fetched = await self.publisher.fetch_feed(transport)
+        if fetched is None:
+            self.finish(0)
+            return False
+        self.new_state, self.content = fetched
+        return True
+
+    async def filter(self):
+        content, self.content = self.content, None
+        selected = await self.publisher.select_entries(content)
+        pipeline.track(self.save(selected))
+        return True
+
+    async def save(self, selected):
+        new_links = 0
+        try:
+            new_links = await self.publisher.save_feed_state(self.new_state, *selected)
+        except Exception as e:
+            metrics.inc('errors', self.publisher.name, e.__class__.__name__)
+            logger_debug.error('{}: feed state - {}'.format(e.__class__.__name__, self.publisher.name))
+        finally:
+            self.finish(new_links)
 
 
 class BasePublisher():
@@ -18,70 +71,197 @@ class BasePublisher():
     name = None
     rss = None
     time_correction = 0
+    # (tag(s), {attribute: value(s)}) of the element(s) parse_body reads the text from, only this subtree is parsed
+    content_container = None
 
     def __init__(self):
-        self.entries_selected = []
+        self.last_links = set()
+        self.date_parser = FeedDateParser()
 
-    async def filter_links_from_rss(self, session):
+    async def filter_links_from_rss(self, transport):
         """
-        Download rss feed and filter it's entries
+        Download rss feed and filter it's entries, selected entries are handed over to the pipeline.
+        Return the number of entries which were not in the feed last time
         """
+        fetched = await self.fetch_feed(transport)
+        if fetched is None:
+            return 0
+        new_state, content = fetched
+        return await self.save_feed_state(new_state, *await self.select_entries(content))
+
+    async def submit_feed(self):
+        """ Like filter_links_from_rss, but the feed goes through the feed stages of the pipeline """
+        return await (await pipeline.submit(FeedJob(self), 'feed'))
+
+    async def fetch_feed(self, transport):
+        """ Return the new feed state and the text of the feed, None if there is nothing new """
+        if not publisher_health.allow(self.name):
+            metrics.inc('feeds', self.name, 'breaker_open')
+            logger_debug.info('Breaker open, skipped - {}'.format(self.name))
+            return None
+        state = feed_states.get(self.name)
         try:
-            response = await session.request('GET', self.rss, timeout=20)
-            content = await response.text()
-        except Exception as e:
-            logger_debug.error('{}: RSS - {}'.format(e.__class__.__name__, self.name))
-            return
-
-        rss_data = feedparser.parse(content)
-
-        if len(rss_data['entries']):
-            for entry in rss_data.get('entries'):
-                publish_dt = parser.parse(entry.published) + timedelta(hours=self.time_correction)
-                try:
-                    is_in_history = await self.is_in_history(entry.link)
-                    matches_keyword = await self.matches_keyword(entry.title)
-                    if not is_in_history and matches_keyword:
-                        self.entries_selected.append(Entry(entry.link, entry.title, publish_dt, self))
-                except AttributeError as e:
-                    logger_debug.error('{}: {}'.format(e.__class__.__name__, e))
+            response, content = await self.fetch_rss(transport, state)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            return None
+        if content is None:
+            metrics.inc('feeds', self.name, 'not_modified')
+            logger_debug.info('RSS not modified - {}'.format(self.name))
+            return None
+
+        new_state = FeedState(response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                              content_hash(content))
+        if new_state.content_hash == state.content_hash:
+            metrics.inc('feeds', self.name, 'not_changed')
+            logger_debug.info('RSS not changed - {}'.format(self.name))
+            return None
+        metrics.inc('feeds', self.name, 'changed')
+        return new_state, content
+
+    async def select_entries(self, content):
+        """
+        Parse the feed and hand over the selected entries to the pipeline, waits while it is full.
+        Return the futures of their results, their publish timestamps, the newest timestamp and
+        the links which were not in the feed last time
+        """
+        # Feeds list the newest entries first, so everything past the watermark has already been processed.
+        # Pinned or back-dated entries can come first though, so single old entries are only skipped
+        watermark = feed_states.get_watermark(self.name)
+        newest = watermark
+        items = []
+        old_in_a_row = 0
+        for item in iter_feed(content):
+            if not item.link or not item.title or not item.published:
+                metrics.inc('errors', self.name, 'IncompleteEntry')
+                logger_debug.error('Incomplete entry: {} - {}'.format(self.name, item.link))
+                continue
+            try:
+                published = self.date_parser.parse(item.published)
+            except (ValueError, OverflowError) as e:
+                metrics.inc('errors', self.name, e.__class__.__name__)
+                logger_debug.error('{}: {} - {}'.format(e.__class__.__name__, self.name, item.published))
+                continue
+            published_ts = timestamp(published)
+            if watermark is not None and published_ts < watermark:
+                old_in_a_row += 1
+                if old_in_a_row >= OLD_ENTRIES_IN_A_ROW:
+                    break
+                continue
+            old_in_a_row = 0
+            newest = published_ts if newest is None else max(newest, published_ts)
+            items.append((item, published, published_ts))
+
+        links = {item.link for item, _, _ in items}
+        new_links, self.last_links = links - self.last_links, links
+        results, selected_ts = [], []
+
+        if items:
+            seen = seen_links.contains_many(links)
+            for item, published, published_ts in items:
+                if item.link in seen:
+                    metrics.inc('entries', self.name, 'seen')
+                    continue
+                # All the topics are evaluated here, the article is downloaded once for those it matches
+                topics = self.match_topics(item.title)
+                if not topics:
+                    metrics.inc('entries', self.name, 'rejected')
                     continue
+                metrics.inc('entries', self.name, 'matched')
+                for topic in topics:
+                    metrics.inc('topic_matched', self.name, topic)
+                publish_dt = published + timedelta(hours=self.time_correction)
+                entry = Entry(item.link, item.title, publish_dt, self, topics)
+                if PREFILTER_MODE != 'off' and not self.prefilter(entry, item.summary):
+                    continue
+                # Waits while the pipeline is full
+                results.append(await pipeline.submit(entry))
+                selected_ts.append(published_ts)
+
+        return results, selected_ts, newest, new_links
+
+    async def save_feed_state(self, new_state, results, selected_ts, newest, new_links):
+        """ Wait for the results of the selected entries and save the feed state, return the number of new links """
+        failed = []
+        if results:
+            results = await asyncio.gather(*results)
+            failed = [published_ts for published_ts, ok in zip(selected_ts, results) if not ok]
+        else:
+            logger_debug.debug('No valid news - {}'.format(self.name))
 
-            if self.entries_selected:
-                coro_downloads = [entry.download_entry(session) for entry in self.entries_selected]
-                await asyncio.gather(*coro_downloads)
-            else:
-                print('No valid news')
-
-    async def matches_keyword(self, entry_title):
-        """ If the entry_title matches any theme keyword, return True """
-        keywords_list = await self.get_keywords_list()
-        for word in keywords_list:
-            p = re.compile(word)
-            if p.search(entry_title.lower()) or p.search(entry_title):
-                # If the entry matches any stop keyword, return False
-                for stop_word in STOP_WORDS:
-                    p1 = re.compile(stop_word)
-                    if p1.search(entry_title.lower()) or p1.search(entry_title):
-                        return False
-                return True
-        return False
-
-    async def is_in_history(self, entry_link):
-        """ If the entry link have already been downloaded, return False """
-        async with aiofiles.open(history_file, "a+", encoding='utf-8-sig') as f:
-            await f.seek(0)
-            history_list = await f.read()
-        if entry_link in history_list:
+        # Failed downloads should be retried, so neither the feed may look unchanged next time
+        # nor the watermark may pass them
+        if failed:
+            feed_states.save_watermark(self.name, min(failed))
+        else:
+            feed_states.save(self.name, new_state)
+            if newest is not None:
+                feed_states.save_watermark(self.name, newest)
+        return len(new_links)
+
+    async def fetch_rss(self, transport, state):
+        """
+        Conditional GET of the feed, failures are retried with exponential backoff unless the breaker opens.
+        Return the response and its text, None if the feed is not modified.
+        """
+        for attempt in range(FEED_RETRIES + 1):
+            try:
+                async with scheduler.slot(self.rss, FEED):
+                    started = time.monotonic()
+                    with metrics.timer('rss_fetch_seconds', self.name):
+                        response = await transport.feeds.request(
+                            'GET', self.rss, headers=conditional_headers(state),
+                            timeout=publisher_health.timeout(self.name, 'feed'))
+                        if response.status == 304:
+                            await response.release()
+                            content = None
+                        elif response.status >= 400:
+                            await response.release()
+                            response.raise_for_status()
+                        else:
+                            content = await response.text()
+                publisher_health.success(self.name, 'feed', time.monotonic() - started)
+                return response, content
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                metrics.inc('errors', self.name, e.__class__.__name__)
+                logger_debug.error('{}: RSS - {}'.format(e.__class__.__name__, self.name))
+                if publisher_health.failure(self.name) or attempt == FEED_RETRIES:
+                    raise
+            await asyncio.sleep(RETRY_DELAY * 2 ** attempt)
+
+    def prefilter(self, entry, summary):
+        """
+        Guess the country of every topic by the title and the rss summary, so that articles which save_entry
+        would drop for all of them are not downloaded. Return False if the entry should be skipped ('skip' mode only).
+        """
+        text = HTML_TAG_RE.sub(' ', summary) if summary else ''
+        if any(topic_profiles[topic].define_country(entry.title, text) for topic in entry.topics):
+            return True
+        if not summary:
+            # Too little to judge by
+            metrics.inc('prefilter', self.name, 'undecided')
             return True
-        return False
+        if PREFILTER_MODE == 'skip':
+            metrics.inc('prefilter', self.name, 'skipped')
+            return False
+        metrics.inc('prefilter', self.name, 'would_skip')
+        entry.prefilter_skip = True
+        return True
 
-    async def get_keywords_list(self):
-        async with aiofiles.open(keyword_file, "a+", encoding='utf-8-sig') as f:
-            await f.seek(0)
-            keywords = await f.readlines()
-            keywords = [l.strip() for l in keywords]
-        return keywords
+    def match_topics(self, entry_title):
+        """ Names of the topics whose keywords (and no stop keyword) the entry_title matches """
+        return topic_profiles.match(entry_title)
+
+    def matches_keyword(self, entry_title):
+        """ If the entry_title matches any theme keyword (and no stop keyword) of any topic, return True """
+        return bool(self.match_topics(entry_title))
+
+    def is_in_history(self, entry_link):
+        """ If the entry link have already been downloaded, return True """
+        return seen_links.contains(entry_link)
 
     def get_divs(self, soup, div_classes, tag='div'):
         divs = []
@@ -104,6 +284,7 @@ class BasePublisher():
 class ApaAz(BasePublisher):
     name = 'APA.AZ'
     rss = 'http://ru.apa.az/rss'
+    content_container = ('div', {'class': 'content'})
 
     def parse_body(self, soup, main_text=''):
         main_text = self.get_main_text(soup, ['content'])
@@ -114,6 +295,7 @@ class Apsny(BasePublisher):
     encoding = 'cp1251'
     name = 'Грузия-онлайн'
     rss = 'http://apsny.ge/RSS.xml'
+    content_container = ('div', {'class': 'txt-item-news'})
 
     def parse_body(self, soup, main_text=''):
         for trash in soup.findAll('a'):
@@ -142,6 +324,8 @@ class Irna(BasePublisher):
     name = 'ИРНА'
     rss = 'http://irna.ir//ru/rss.aspx?kind=701'
     time_correction = -4.5
+    content_container = (['h3', 'p'], {'id': ['ctl00_ctl00_ContentPlaceHolder_ContentPlaceHolder_NewsContent1_H1',
+                                           'ctl00_ctl00_ContentPlaceHolder_ContentPlaceHolder_NewsContent1_BodyLabel']})
 
     def parse_body(self, soup, main_text=''):
         main_text += '\n' + soup.find('h3', {
@@ -155,6 +339,7 @@ class Kommersant(BasePublisher):
     encoding = 'cp1251'
     name = 'Коммерсант'
     rss = 'http://www.kommersant.ru/RSS/news.xml'
+    content_container = ('p', {'class': 'b-article__text'})
 
     def parse_body(self, soup, main_text=''):
         for everyitem in soup.findAll('p', {'class': 'b-article__text'}):
@@ -189,6 +374,7 @@ class NewsAsia(BasePublisher):
     encoding = 'cp1251'
     name = 'News-Asia'
     rss = 'http://www.news-asia.ru/rss/all'
+    content_container = ('div', {'class': 'content'})
 
     def parse_body(self, soup, main_text=''):
         main_text = self.get_main_text(soup, ['content'])
@@ -198,6 +384,7 @@ class NewsAsia(BasePublisher):
 class RussiaToday(BasePublisher):
     name = 'RussiaToday'
     rss = 'http://russian.rt.com/rss/'
+    content_container = ('div', {'class': ['article__summary', 'article__text']})
 
     def parse_body(self, soup, main_text=''):
         for everyitem in soup.findAll('p', {'class': 'disclaimer'}):
@@ -209,6 +396,7 @@ class RussiaToday(BasePublisher):
 class Korrespondent(BasePublisher):
     name = 'Корреспондент'
     rss = 'http://k.img.com.ua/rss/ru/ukraine.xml'
+    content_container = ('div', {'class': 'post-item__text'})
 
     def parse_body(self, soup, main_text=''):
         main_text = soup.find('div', {'class': 'post-item__text'}).text
@@ -218,6 +406,7 @@ class Korrespondent(BasePublisher):
 class Unian(BasePublisher):
     name = 'УНИАН'
     rss = 'http://rss.unian.net/site/news_rus.rss'
+    content_container = ('span', {'itemprop': 'articleBody'})
 
     def parse_body(self, soup, main_text=''):
         main_text_list = []
@@ -236,6 +425,7 @@ class Unian(BasePublisher):
 class Ukrinform(BasePublisher):
     name = 'Укринформ'
     rss = 'http://www.ukrinform.ru/rss/'
+    content_container = ('div', {'class': ['newsHeading', 'newsText']})
 
     def parse_body(self, soup, main_text=''):
         divs = self.get_divs(soup, ['newsHeading'])
@@ -252,6 +442,7 @@ class Ukrinform(BasePublisher):
 class RBKRussia(BasePublisher):
     name = 'РБК'
     rss = 'http://static.feed.rbc.ru/rbc/internal/rss.rbc.ru/rbc.ru/mainnews.rss'
+    content_container = ('div', {'class': 'article__text'})
 
     def parse_body(self, soup, main_text=''):
         main_text = self.get_main_text(soup, ['article__text'])
@@ -261,6 +452,7 @@ class RBKRussia(BasePublisher):
 class BBC(BasePublisher):
     name = 'Би-Би-Си'
     rss = 'http://www.bbc.co.uk/russian/index.xml'
+    content_container = ('div', {'class': ['story-body__inner', 'map-body', 'story-body']})
 
     def parse_body(self, soup, main_text=''):
         main_text = self.get_main_text(soup, ['story-body__inner', 'map-body', 'story-body'])
@@ -270,6 +462,7 @@ class BBC(BasePublisher):
 class Lenta(BasePublisher):
     name = 'Лента.ру'
     rss = 'http://lenta.ru/rss'
+    content_container = ('div', {'itemprop': 'articleBody'})
 
     def parse_body(self, soup, main_text=''):
         for everyitem in soup.find('div', {'itemprop': 'articleBody'}).findAll('p'):
@@ -280,6 +473,7 @@ class Lenta(BasePublisher):
 class Rian(BasePublisher):
     name = 'РИА-Новости-Украина'
     rss = 'http://rian.com.ua/export/rss2/politics/index.xml'
+    content_container = ('div', {'itemprop': 'articleBody'})
 
     def parse_body(self, soup, main_text=''):
         for everyitem in soup.findAll('p', {'style': 'text-align: center;'}):
@@ -292,6 +486,7 @@ class Rian(BasePublisher):
 class Trend(BasePublisher):
     name = 'Тренд'
     rss = 'http://www.trend.az/feeds/index.rss'
+    content_container = ('div', {'itemprop': 'articleBody'})
 
     def parse_body(self, soup, main_text=''):
         for everyitem in soup.find('div', {'itemprop': 'articleBody'}).findAll('p'):
@@ -303,6 +498,7 @@ class Trend(BasePublisher):
 class KavkazUzel(BasePublisher):
     name = 'Кавказский узел'
     rss = 'http://www.kavkaz-uzel.ru/articles.rss/'
+    content_container = ('div', {'class': 'articles-body'})
 
     def parse_body(self, soup, main_text=''):
         for everyitem in soup.findAll('div', {'class': 'lt-feedback_banner pull-right hidden-phone'}):
@@ -315,6 +511,7 @@ class KavkazUzel(BasePublisher):
 class Vedomosti(BasePublisher):
     name = 'Ведомости'
     rss = 'http://www.vedomosti.ru/newsline/out/rss.xml'
+    content_container = ('div', {'class': 'b-news-item__text b-news-item__text_one'})
 
     def parse_body(self, soup, main_text=''):
         main_text = self.get_main_text(soup, ['b-news-item__text b-news-item__text_one'])
@@ -324,6 +521,7 @@ class Vedomosti(BasePublisher):
 class ItarTass(BasePublisher):
     name = 'ИТАР-ТАСС'
     rss = 'http://itar-tass.com/rss/v2.xml'
+    content_container = ('div', {'class': 'b-material-text__l'})
 
     def parse_body(self, soup, main_text=''):
         for everyitem in soup.findAll('div', {'class': 'b-gallery-widget-item'}):
@@ -342,6 +540,7 @@ class ItarTass(BasePublisher):
 class Rosbalt(BasePublisher):
     name = 'Росбалт'
     rss = 'http://www.rosbalt.ru/feed/'
+    content_container = ('div', {'class': 'newstext'})
 
     def parse_body(self, soup, main_text=''):
         main_text = self.get_main_text(soup, ['newstext'])
@@ -355,6 +554,7 @@ class Rosbalt(BasePublisher):
 class VPK(BasePublisher):
     name = 'ВПК'
     rss = 'http://vpk-news.ru/feed'
+    content_container = ('div', {'class': 'field-name-body'})
 
     def parse_body(self, soup, main_text=''):
         div = soup.find('div', {'class': 'field-name-body'})
@@ -365,6 +565,7 @@ class VPK(BasePublisher):
 class Fergana(BasePublisher):
     name = 'Фергана'
     rss = 'http://www.fergananews.com/rss.php'
+    content_container = ('div', {'id': 'text'})
 
     def parse_body(self, soup, main_text=''):
         for everyitem in soup.findAll('div', {'id': 'text'}):
@@ -375,6 +576,7 @@ class Fergana(BasePublisher):
 class Sputnik(BasePublisher):
     name = 'Спутник'
     rss = 'https://sputnik-georgia.ru/export/rss2/archive/index.xml'
+    content_container = ('div', {'class': 'b-article__text'})
 
     def parse_body(self, soup, main_text=''):
         for everyitem in soup.findAll('div', {'class': 'b-inject'}):
@@ -386,6 +588,7 @@ class Sputnik(BasePublisher):
 class ApsnyPress(BasePublisher):
     name = 'Апсны-Пресс'
     rss = 'http://www.apsnypress.info/news/rss/'
+    content_container = ('div', {'class': 'detail_text'})
 
     def parse_body(self, soup, main_text=''):
         main_text = soup.find('div', {'class': 'detail_text'}).text
@@ -395,6 +598,7 @@ class ApsnyPress(BasePublisher):
 class Sana(BasePublisher):
     name = 'САНА'
     rss = 'http://sana.sy/ru/?feed=rss2'
+    content_container = ('div', {'class': 'entry'})
 
     def parse_body(self, soup, main_text=''):
         main_text = self.get_main_text(soup, ['entry'])
@@ -404,6 +608,7 @@ class Sana(BasePublisher):
 class DAN(BasePublisher):
     name = 'ДАН'
     rss = 'http://dan-news.info/feed'
+    content_container = ('div', {'class': 'entry'})
 
     def parse_body(self, soup, main_text=''):
         main_text = self.get_main_text(soup, ['entry'])
@@ -413,6 +618,7 @@ class DAN(BasePublisher):
 class Anadolu(BasePublisher):
     name = 'Анадолу'
     rss = 'http://aa.com.tr/ru/rss/default?cat=live'
+    content_container = ('div', {'class': 'article-post-content'})
 
     def parse_body(self, soup, main_text=''):
         main_text = self.get_main_text(soup, ['article-post-content'])
@@ -422,6 +628,7 @@ class Anadolu(BasePublisher):
 class ArmenPress(BasePublisher):
     name = 'Арменпресс'
     rss = 'http://armenpress.am/rus/rss/news/'
+    content_container = ('span', {'itemprop': 'articleBody'})
 
     def parse_body(self, soup, main_text=''):
         for everyitem in soup.find('span', {'itemprop': 'articleBody'}).findAll('p'):
@@ -430,13 +637,20 @@ class ArmenPress(BasePublisher):
 
 
 if __name__ == '__main__':
+    from storage import open_storages, close_storages
+    from transport import Transport
+
     async def main(loop):
-        async with aiohttp.ClientSession(loop=loop) as session:
+        await open_storages()
+        async with Transport(loop) as transport:
+            pipeline.start(transport)
             publisher = Unian()
             try:
-                await publisher.filter_links_from_rss(session)
+                await publisher.filter_links_from_rss(transport)
             except Exception as e:
                 logger_debug.error('{}: {}'.format(e.__class__.__name__, publisher.name))
+            await pipeline.close()
+        await close_storages()
 
 
     loop = asyncio.get_event_loop()
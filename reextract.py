@@ -0,0 +1,97 @@
+"""
+Run the current parse_body, define_country and save_entry again over the archived pages, without network access.
+Already stored articles are overwritten, so texts lost to a broken parser can be recovered after the fix.
+The titles are matched against the current topic profiles again, pages no topic matches any more are left alone.
+
+    python reextract.py --publishers Irna,Camto --since 2017-06-01 --until 2017-06-15
+    python reextract.py --dry-run
+"""
+import argparse
+import asyncio
+import collections
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from archive import page_archive, read_body, decode_dt
+from entries import Entry
+from extraction import extract_text, get_publisher
+from settings import logger_debug
+from storage import open_storages, close_storages, writers
+from topics import topic_profiles
+
+BATCH_SIZE = 200
+
+
+def extract_record(path, record):
+    """ Runs in a worker process: read the page from the archive and extract the text """
+    body = read_body(path, record['segment'], record['offset'], record['length'])
+    return extract_text(body, record['publisher'], record['encoding'])
+
+
+def select_records(records, publishers=None, since=None, until=None):
+    """ Index records of the given publishers (class names) archived between since and until, oldest first """
+    selected = [record for record in records
+                if (not publishers or record['publisher'] in publishers)
+                and (since is None or record['archived_at'] >= since)
+                and (until is None or record['archived_at'] < until)]
+    return sorted(selected, key=lambda record: record['archived_at'])
+
+
+async def reextract(loop, records, workers, dry_run=False):
+    counts = collections.Counter()
+    if not dry_run:
+        await open_storages()
+        for writer in writers:
+            writer.overwrite = True
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for i in range(0, len(records), BATCH_SIZE):
+                batch = records[i:i + BATCH_SIZE]
+                texts = await asyncio.gather(
+                    *[loop.run_in_executor(pool, extract_record, page_archive.path, record) for record in batch],
+                    return_exceptions=True)
+                for record, text in zip(batch, texts):
+                    if isinstance(text, Exception):
+                        counts['failed'] += 1
+                        logger_debug.error('{}: re-extract - {}'.format(text.__class__.__name__, record['link']))
+                        continue
+                    counts['extracted' if text else 'empty'] += 1
+                    topics = topic_profiles.match(record['title'])
+                    if not topics:
+                        counts['no_topic'] += 1
+                        continue
+                    entry = Entry(record['link'], record['title'],
+                                  decode_dt(record['publish_ts'], record['publish_offset']),
+                                  get_publisher(record['publisher']), topics)
+                    entry.main_text = text
+                    entry.define_country()
+                    counts['country' if entry.country != 'Другие' else 'no_country'] += 1
+                    if not dry_run:
+                        await entry.store()
+    finally:
+        if not dry_run:
+            await close_storages()
+    return counts
+
+
+def parse_date(value):
+    return time.mktime(time.strptime(value, '%Y-%m-%d'))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--publishers', type=lambda value: [name.strip() for name in value.split(',')],
+                            help='comma separated class names of the publishers, e.g. Irna,Camto')
+    arg_parser.add_argument('--since', type=parse_date, help='YYYY-MM-DD, pages archived on this day or later')
+    arg_parser.add_argument('--until', type=parse_date, help='YYYY-MM-DD, pages archived before this day')
+    arg_parser.add_argument('--workers', type=int, default=os.cpu_count(), help='extraction processes')
+    arg_parser.add_argument('--dry-run', action='store_true', help='only extract and classify, store nothing')
+    args = arg_parser.parse_args()
+
+    records = select_records(page_archive.load().values(), args.publishers, args.since, args.until)
+    loop = asyncio.get_event_loop()
+    counts = loop.run_until_complete(reextract(loop, records, args.workers, args.dry_run))
+    loop.close()
+    print('{} pages: {}'.format(len(records), ', '.join('{} {}'.format(value, key)
+                                                         for key, value in sorted(counts.items()))))
@@ -0,0 +1,114 @@
+import asyncio
+import heapq
+import itertools
+from urllib.parse import urlparse
+
+from settings import MAX_REQUESTS, MAX_REQUESTS_PER_HOST, HOST_REQUEST_INTERVAL
+
+# Priorities, lower goes first
+FEED = 0
+ARTICLE = 1
+
+
+def host_of(url):
+    return urlparse(url).hostname or ''
+
+
+class Slot():
+    """ async with scheduler.slot(url, priority): ... holds one request slot """
+
+    def __init__(self, scheduler, url, priority):
+        self.scheduler = scheduler
+        self.host = host_of(url)
+        self.priority = priority
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.host, self.priority)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.scheduler.release(self.host)
+
+
+class RequestScheduler():
+    """
+    Limits concurrent HTTP requests: max_requests in flight overall, max_per_host per host, and requests to the
+    same host are started at least host_interval seconds apart. Waiting requests are served by priority,
+    so RSS feeds overtake article downloads.
+    """
+
+    def __init__(self, max_requests, max_per_host, host_interval):
+        self.max_requests = max_requests
+        self.max_per_host = max_per_host
+        self.host_interval = host_interval
+        self.in_flight = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.waiters = []  # heap of (priority, order, future)
+        self.order = itertools.count()
+        self.hosts = {}
+        self.next_start = {}
+
+    def slot(self, url, priority=ARTICLE):
+        return Slot(self, url, priority)
+
+    @property
+    def queue_depth(self):
+        return self.waiting
+
+    def stats(self):
+        return {'in_flight': self.in_flight, 'queue_depth': self.waiting, 'max_queue_depth': self.max_waiting}
+
+    async def acquire(self, host, priority):
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            semaphore = self.hosts.get(host)
+            if semaphore is None:
+                semaphore = self.hosts[host] = asyncio.Semaphore(self.max_per_host)
+            await semaphore.acquire()
+            try:
+                await self.pace(host)
+                await self.acquire_global(priority)
+            except BaseException:
+                semaphore.release()
+                raise
+        finally:
+            self.waiting -= 1
+
+    async def pace(self, host):
+        now = asyncio.get_event_loop().time()
+        start = max(now, self.next_start.get(host, now))
+        self.next_start[host] = start + self.host_interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def acquire_global(self, priority):
+        if self.in_flight < self.max_requests and not self.waiters:
+            self.in_flight += 1
+            return
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.order), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over right before the cancellation
+            if future.done() and not future.cancelled():
+                self.release_global()
+            raise
+
+    def release_global(self):
+        while self.waiters:
+            future = heapq.heappop(self.waiters)[2]
+            if not future.done():
+                # Hand the slot over, in_flight stays the same
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def release(self, host):
+        self.release_global()
+        self.hosts[host].release()
+
+
+scheduler = RequestScheduler(MAX_REQUESTS, MAX_REQUESTS_PER_HOST, HOST_REQUEST_INTERVAL)
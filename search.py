@@ -0,0 +1,99 @@
+"""
+Search of the stored news in PostgreSQL, by text, country and publish time:
+
+    python search.py "зенитный комплекс" --country Украина --since 2017-06-01 --page 2
+    python search.py "нефть" --topic economics
+    python search.py --backfill --topic economics
+"""
+import argparse
+import asyncio
+from datetime import datetime, timezone
+
+import sqlalchemy as sa
+
+from pg_storage import connect, backfill, news_tbl, news_table, ts_config
+from settings import TOPIC_PROFILES
+
+PER_PAGE = 20
+MAX_PER_PAGE = 100
+
+
+def search_query(text=None, country=None, since=None, until=None, page=1, per_page=PER_PAGE, table=news_tbl):
+    """
+    Select one page of news, one row more than per_page tells whether there is a next page.
+    Text searches are ordered by relevance, everything else newest first.
+    """
+    per_page = min(per_page, MAX_PER_PAGE)
+    columns = [table.c.title, table.c.link, table.c.rss, table.c.country_id, table.c.published_at,
+               table.c.duplicate_of]
+    conditions = []
+    order_by = [table.c.published_at.desc()]
+    if text:
+        tsquery = sa.func.plainto_tsquery(ts_config(), text)
+        rank = sa.func.ts_rank(table.c.search_vector, tsquery)
+        columns += [rank.label('rank'),
+                    sa.func.ts_headline(ts_config(), table.c.body, tsquery, 'MaxFragments=2').label('headline')]
+        conditions.append(table.c.search_vector.op('@@')(tsquery))
+        order_by.insert(0, sa.desc('rank'))
+    if country:
+        conditions.append(table.c.country_id == country)
+    if since:
+        conditions.append(table.c.published_at >= since)
+    if until:
+        conditions.append(table.c.published_at < until)
+    return (sa.select(columns).where(sa.and_(*conditions)).order_by(*order_by)
+            .limit(per_page + 1).offset((page - 1) * per_page))
+
+
+async def search(engine, text=None, country=None, since=None, until=None, page=1, per_page=PER_PAGE,
+                 table=news_tbl):
+    """ Return (rows of the page as dicts, whether there is a next page) """
+    per_page = min(per_page, MAX_PER_PAGE)
+    async with engine.acquire() as conn:
+        result = await conn.execute(search_query(text, country, since, until, page, per_page, table))
+        rows = [dict(row) for row in await result.fetchall()]
+    return rows[:per_page], len(rows) > per_page
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+
+
+async def main(args):
+    table = news_table(TOPIC_PROFILES[args.topic]['sinks']['PostgreSQL'])
+    engine = await connect(maxsize=1)
+    try:
+        if args.backfill:
+            await backfill(engine, table.name)
+            return
+        rows, more = await search(engine, args.text, args.country, args.since, args.until, args.page, args.per_page,
+                                  table)
+        for row in rows:
+            print('{} | {} | {} | {}'.format(row['published_at'], row['country_id'], row['title'], row['link']))
+            if row.get('headline'):
+                print('    {}'.format(' '.join(row['headline'].split())))
+        if more:
+            print('... more on page {}'.format(args.page + 1))
+    finally:
+        engine.close()
+        await engine.wait_closed()
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('text', nargs='?', help='words to search in titles and bodies')
+    arg_parser.add_argument('--country', help='e.g. Украина')
+    arg_parser.add_argument('--since', type=parse_date, help='YYYY-MM-DD, published on this day or later (UTC)')
+    arg_parser.add_argument('--until', type=parse_date, help='YYYY-MM-DD, published before this day (UTC)')
+    arg_parser.add_argument('--topic', default='militar',
+                            choices=[name for name, topic in TOPIC_PROFILES.items() if 'PostgreSQL' in topic['sinks']],
+                            help='topic profile whose table is searched')
+    arg_parser.add_argument('--page', type=int, default=1)
+    arg_parser.add_argument('--per-page', type=int, default=PER_PAGE)
+    arg_parser.add_argument('--backfill', action='store_true',
+                            help='fill published_at and the search vector of rows stored before they existed')
+    args = arg_parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(args))
+    loop.close()
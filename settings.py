@@ -4,7 +4,6 @@ from logging.handlers import RotatingFileHandler
 import collections
 
 from pytz import timezone
-import motor.motor_asyncio
 
 DEBUG = os.environ.get('DEBUG', False)
 
@@ -17,15 +16,107 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 log_file = os.path.join(basedir, 'debug.log')
 keyword_file = os.path.join(basedir, 'keywords_militar.txt')
 history_file = os.path.join(basedir, 'history.log')
+# Written at the end of every run, an empty value switches the file off
+METRICS_PROM_FILE = os.environ.get('METRICS_PROM_FILE', os.path.join(basedir, 'metrics.prom'))
+METRICS_JSON_FILE = os.environ.get('METRICS_JSON_FILE', os.path.join(basedir, 'metrics.json'))
+# Quantiles of timings are estimated from this many random samples per timing, counts and sums are exact
+METRICS_RESERVOIR_SIZE = int(os.environ.get('METRICS_RESERVOIR_SIZE', 1024))
+# The daemon serves /metrics and /metrics.json on this port, 0 - off
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+state_db = os.path.join(basedir, 'harvester.sqlite3')
+# A process waits at most this many sec for another one writing to harvester.sqlite3
+STATE_DB_TIMEOUT = float(os.environ.get('STATE_DB_TIMEOUT', 5))
+# Downloaded pages are kept here for re-extraction, an empty value switches the archive off
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(basedir, 'archive'))
+ARCHIVE_SEGMENT_BYTES = int(os.environ.get('ARCHIVE_SEGMENT_BYTES', 64 * 1024 * 1024))
+
+# Downloaded links are remembered for this many days
+HISTORY_TTL_DAYS = int(os.environ.get('HISTORY_TTL_DAYS', 90))
+
+# DOWNLOADS
+# Requests in flight overall and per host, requests to one host are started at least HOST_REQUEST_INTERVAL sec apart
+MAX_REQUESTS = int(os.environ.get('MAX_REQUESTS', 20))
+MAX_REQUESTS_PER_HOST = int(os.environ.get('MAX_REQUESTS_PER_HOST', 2))
+HOST_REQUEST_INTERVAL = float(os.environ.get('HOST_REQUEST_INTERVAL', 0.5))
+
+# HTTP
+# Connections are kept alive for HTTP_KEEPALIVE sec, resolved addresses are cached for HTTP_DNS_TTL sec
+USER_AGENT = os.environ.get('USER_AGENT', 'Mozilla/5.0 (compatible; Harvester/1.0)')
+HTTP_KEEPALIVE = float(os.environ.get('HTTP_KEEPALIVE', 30))
+HTTP_DNS_TTL = int(os.environ.get('HTTP_DNS_TTL', 300))
+FEED_CONNECT_TIMEOUT = float(os.environ.get('FEED_CONNECT_TIMEOUT', 5))
+FEED_READ_TIMEOUT = float(os.environ.get('FEED_READ_TIMEOUT', 15))
+ARTICLE_CONNECT_TIMEOUT = float(os.environ.get('ARTICLE_CONNECT_TIMEOUT', 5))
+ARTICLE_READ_TIMEOUT = float(os.environ.get('ARTICLE_READ_TIMEOUT', 20))
+
+# Guess the country of matched entries by title and rss summary before downloading them:
+# 'off', 'report' - only count the guesses, 'skip' - do not download entries without a country
+PREFILTER_MODE = os.environ.get('PREFILTER_MODE', 'report')
+
+# Larger article pages are not downloaded
+ARTICLE_MAX_BYTES = int(os.environ.get('ARTICLE_MAX_BYTES', 2 * 1024 * 1024))
+
+# Size of the process pool for html parsing, 0 - parse in the event loop thread
+EXTRACT_WORKERS = int(os.environ.get('EXTRACT_WORKERS', 0))
+
+# PROFILING
+# PROFILE switches on cProfile and tracemalloc for every pipeline stage and every publisher's parse_body,
+# reports of a run are written to a new directory in PROFILE_DIR. Extraction runs in the event loop thread then
+PROFILE = os.environ.get('PROFILE', False)
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(basedir, 'profiles'))
+# Functions / allocating lines in the reports, and every how many calls the allocations are sampled
+PROFILE_TOP = int(os.environ.get('PROFILE_TOP', 25))
+PROFILE_SAMPLE_EVERY = int(os.environ.get('PROFILE_SAMPLE_EVERY', 10))
+
+# PIPELINE
+# Feeds go through the stages feed (fetch) -> filter, the selected entries through download -> extract -> classify
+# -> store. Every stage has its own workers and the stages are connected by queues of PIPELINE_QUEUE_SIZE items,
+# a full queue blocks the stage before it. Downloads are queued per host, at most MAX_REQUESTS_PER_HOST workers
+# take entries of one host at a time
+PIPELINE_FEED_FETCHERS = int(os.environ.get('PIPELINE_FEED_FETCHERS', MAX_REQUESTS))
+PIPELINE_FILTERS = int(os.environ.get('PIPELINE_FILTERS', 2))
+PIPELINE_DOWNLOADERS = int(os.environ.get('PIPELINE_DOWNLOADERS', MAX_REQUESTS))
+PIPELINE_EXTRACTORS = int(os.environ.get('PIPELINE_EXTRACTORS', max(1, EXTRACT_WORKERS)))
+PIPELINE_CLASSIFIERS = int(os.environ.get('PIPELINE_CLASSIFIERS', 1))
+PIPELINE_STORERS = int(os.environ.get('PIPELINE_STORERS', 1))
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 50))
+
+# HEALTH
+# The breaker of a publisher opens after BREAKER_THRESHOLD failures in a row, it is tried again after
+# BREAKER_BACKOFF sec, doubled with every further failure up to BREAKER_MAX_BACKOFF
+BREAKER_THRESHOLD = int(os.environ.get('BREAKER_THRESHOLD', 3))
+BREAKER_BACKOFF = float(os.environ.get('BREAKER_BACKOFF', 300))
+BREAKER_MAX_BACKOFF = float(os.environ.get('BREAKER_MAX_BACKOFF', 6 * 3600))
+# Failed rss fetches are retried this many times in the same run, after RETRY_DELAY sec, doubled every time
+FEED_RETRIES = int(os.environ.get('FEED_RETRIES', 1))
+RETRY_DELAY = float(os.environ.get('RETRY_DELAY', 1))
+# Request timeouts are TIMEOUT_FACTOR times the p95 latency of the publisher, at least MIN_TIMEOUT
+# and at most FEED_READ_TIMEOUT or ARTICLE_READ_TIMEOUT
+MIN_TIMEOUT = float(os.environ.get('MIN_TIMEOUT', 3))
+TIMEOUT_FACTOR = float(os.environ.get('TIMEOUT_FACTOR', 3))
+# main.py cancels the publishers which are still running after RUN_DEADLINE sec, 0 - no deadline
+RUN_DEADLINE = float(os.environ.get('RUN_DEADLINE', 0))
+
+# DAEMON
+# Every feed is polled at most every POLL_MIN_INTERVAL and at least every POLL_MAX_INTERVAL sec, in between
+# the interval is chosen to find about POLL_TARGET_ITEMS new entries per poll
+POLL_MIN_INTERVAL = float(os.environ.get('POLL_MIN_INTERVAL', 60))
+POLL_MAX_INTERVAL = float(os.environ.get('POLL_MAX_INTERVAL', 1800))
+POLL_TARGET_ITEMS = float(os.environ.get('POLL_TARGET_ITEMS', 3))
+POLL_JITTER = float(os.environ.get('POLL_JITTER', 0.1))
+
+# 'html.parser' or 'lxml' (if installed, much faster)
+HTML_PARSER = os.environ.get('HTML_PARSER', 'html.parser')
 
 # LOGGING
 logger_debug = logging.getLogger('logger_debug')
 formatter = logging.Formatter(
     '%(filename)s |%(funcName)s| [LINE:%(lineno)d]# %(levelname)-8s [%(asctime)s]  %(message)s')
 handler = RotatingFileHandler(log_file, mode='a', maxBytes=500 * 1024, backupCount=1, delay=0, encoding='utf8')
-handler.setLevel(logging.INFO)
+handler.setLevel(logging.DEBUG if DEBUG else logging.INFO)
 handler.setFormatter(formatter)
 logger_debug.addHandler(handler)
+logger_debug.setLevel(logging.DEBUG if DEBUG else logging.INFO)
 
 logger_history = logging.getLogger('logger_history')
 handler2 = RotatingFileHandler(history_file, mode='a', maxBytes=500 * 1024, backupCount=1, delay=0, encoding='utf8')
@@ -35,28 +126,42 @@ handler2.setFormatter(formatter2)
 logger_history.addHandler(handler2)
 
 # STORAGES
+# What to do with an article which is a near duplicate of one stored in the last NEAR_DUP_DAYS days:
+# 'skip' it, store it as a 'reference' to the first one (without the body) or 'off' - store it as usual
+NEAR_DUP_MODE = os.environ.get('NEAR_DUP_MODE', 'reference')
+NEAR_DUP_DAYS = int(os.environ.get('NEAR_DUP_DAYS', 3))
+
 USE_POSTGRESQL = os.environ.get('POSTGRESQL_HARVESTER', False)
 USE_MONGODB = os.environ.get('MONGODB', False)
 USE_ELASTICSEARCH = os.environ.get('ELASTICSEARCH', False)
 
+# Entries are buffered and written in batches of this size, or at least every STORAGE_FLUSH_INTERVAL seconds
+STORAGE_BATCH_SIZE = int(os.environ.get('STORAGE_BATCH_SIZE', 100))
+STORAGE_FLUSH_INTERVAL = float(os.environ.get('STORAGE_FLUSH_INTERVAL', 5))
+
 # POSTGRESQL
 PG_DB = os.environ.get('PG_NAME_HARVESTER')
 PG_USER = os.environ.get('PG_USER')
 PG_PASSWORD = os.environ.get('PG_PASS')
+PG_POOL_SIZE = int(os.environ.get('PG_POOL_SIZE', 5))
+# Text search configuration of the precomputed tsvector of title and body
+PG_TS_CONFIG = os.environ.get('PG_TS_CONFIG', 'russian')
+# Create app_news partitioned by month of published_at (PostgreSQL 11+), only applies to a new table
+PG_PARTITION_BY_MONTH = os.environ.get('PG_PARTITION_BY_MONTH', False)
 
 # MONGODB
 MONGO_HOST = os.environ.get('MONGO_HOST', 'localhost')
 MONGO_PORT = int(os.environ.get('MONGO_PORT', 27017))
 MONGO_URI = 'mongodb://localhost:27017'
-MONGO_DB = None
-if USE_MONGODB:
-    client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_HOST, MONGO_PORT)
-    MONGO_DB = client['harvester_db']
+MONGO_DB_NAME = os.environ.get('MONGO_DB_NAME', 'harvester_db')
 
 # ELASTICSEARCH
 ES_HOST = os.environ.get('ES_HOST', 'localhost')
 ES_PORT = int(os.environ.get('ES_PORT', 9200))
 
+# How to choose a country when the text matches several of them: 'last', 'first' or 'most' (hits)
+COUNTRY_POLICY = os.environ.get('COUNTRY_POLICY', 'last')
+
 STOP_WORDS = ['бокс[её]р', 'хоккеист', 'Бессмертн', 'зв[её]здны[а-я]{,2} войн', '\\bВойнов', '\\bПутин',
               'велик[а-я]{2} отечествен', 'втор[а-я]{2} миров', 'Война и мир', 'Лавров', 'Песков', 'Захарова', 'МО РФ:',
               'Минобороны РФ:', 'МИД РФ']
@@ -143,3 +248,22 @@ COUNTRIES_KEYWORDS = collections.OrderedDict([
       '\\bангол', 'ЦАР', 'Бенин', 'Габон', 'ЮАР', 'эфиоп', 'джибут', '\\bБуркина', '\\bЧаде\\b', '\\bЧада\\b',
       'Сомали'), 'Африка'),
 ])
+
+# TOPICS
+# Every profile filters the titles by the keywords of its file and its stop words, defines the countries by its own
+# map and is stored to its own targets: the PostgreSQL table, the MongoDB database and the Elasticsearch index.
+# A storage missing in 'sinks' gets nothing of the profile. All TOPICS are evaluated in one run, an article matched
+# by several of them is downloaded once and stored for each of them
+TOPIC_PROFILES = collections.OrderedDict([
+    ('militar', {'keyword_file': keyword_file,
+                 'stop_words': STOP_WORDS,
+                 'countries_keywords': COUNTRIES_KEYWORDS,
+                 'sinks': {'PostgreSQL': 'app_news', 'MongoDB': MONGO_DB_NAME, 'Elasticsearch': 'harvester'}}),
+    ('economics', {'keyword_file': os.path.join(basedir, 'keywords_economics.txt'),
+                   'stop_words': ['футбол', 'хоккей', 'трансфер', 'экономкласс'],
+                   'countries_keywords': COUNTRIES_KEYWORDS,
+                   'sinks': {'PostgreSQL': 'app_news_economics', 'MongoDB': 'harvester_economics',
+                             'Elasticsearch': 'harvester_economics'}}),
+])
+# Comma separated names of the profiles to evaluate
+TOPICS = [name.strip() for name in os.environ.get('TOPICS', 'militar').split(',') if name.strip()]
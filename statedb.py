@@ -0,0 +1,15 @@
+import sqlite3
+
+from settings import STATE_DB_TIMEOUT
+
+
+def connect(path, timeout=STATE_DB_TIMEOUT):
+    """
+    Connection to the shared state database. In WAL mode readers do not wait for writers and a writer only
+    waits for another writer's (short) transaction, so processes of one machine rarely block each other.
+    """
+    conn = sqlite3.connect(path, timeout=timeout)
+    conn.execute('PRAGMA journal_mode=WAL')
+    # Durable enough in WAL mode, a power loss may only lose the last transactions
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
@@ -1,94 +1,200 @@
-import datetime
-from aiopg.sa import create_engine
-import sqlalchemy as sa
-from psycopg2 import IntegrityError
-from aioelasticsearch import Elasticsearch
-from slugify import slugify
-
-from settings import (TEXT_SIZE_LIMIT, USE_POSTGRESQL, USE_MONGODB, USE_ELASTICSEARCH, PG_DB, PG_USER, PG_PASSWORD,
-                      MONGO_DB)
-
-es_client = Elasticsearch()
-
-metadata = sa.MetaData()
-
-news_tbl = sa.Table('app_news', metadata,
-                    sa.Column('id', sa.Integer, primary_key=True),
-                    sa.Column('rss', sa.String(255)),
-                    sa.Column('title', sa.Text()),
-                    sa.Column('body', sa.Text()),
-                    sa.Column('pub_time', sa.DateTime()),
-                    sa.Column('country_id', sa.String(255)),
-                    sa.Column('link', sa.Text(), unique=True),
-                    sa.Column('download_time', sa.DateTime(), default=datetime.datetime.now)
-                    )
-
-countries_tbl = sa.Table('app_countries', metadata,
-                         sa.Column('name', sa.String(255), primary_key=True),
-                         sa.Column('slug', sa.String(255))
-                         )
-
-
-async def create_tables(engine):
-    async with engine.acquire() as conn:
-        await conn.execute('''CREATE TABLE IF NOT EXISTS app_news (
-                                  id SERIAL PRIMARY KEY,
-                                  rss VARCHAR(255),
-                                  title VARCHAR,
-                                  body VARCHAR,
-                                  pub_time VARCHAR(255),
-                                  download_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                                  country_id VARCHAR(255),
-                                  link VARCHAR,
-                                  UNIQUE (link)
-                                  )''')
-        await conn.execute('''CREATE TABLE IF NOT EXISTS app_countries (
-                                  name VARCHAR(255) PRIMARY KEY,
-                                  slug VARCHAR(255)
-                                  )''')
+import asyncio
+import hashlib
+import importlib
+
+from classifier import DEFAULT_COUNTRY
+from dedup import near_duplicates
+from metrics import metrics
+from settings import (NEAR_DUP_MODE, TEXT_SIZE_LIMIT, USE_POSTGRESQL, USE_MONGODB, USE_ELASTICSEARCH,
+                      STORAGE_BATCH_SIZE, STORAGE_FLUSH_INTERVAL, logger_debug)
+from topics import topic_profiles
+
+# Writers of the storages by the flag which enables them, their modules (and drivers) are only imported if enabled.
+# A writer is created for every target (table, database or index) of the topic profiles
+STORAGES = ((USE_POSTGRESQL, 'pg_storage', 'PostgresWriter'),
+            (USE_MONGODB, 'mongo_storage', 'MongoWriter'),
+            (USE_ELASTICSEARCH, 'es_storage', 'ElasticsearchWriter'))
+
+
+class BufferedWriter():
+    """
+    Collects entries in memory and writes them in batches, by size or by time. Every added entry gets a future
+    which tells whether its batch has been written, so that it is only taken as done once it is in the storage.
+    """
+    name = None
+    # Replace already stored articles instead of keeping them (re-extraction)
+    overwrite = False
+    # Names of the topics routed to the writer, None - all of them
+    topics = None
+
+    def __init__(self, target=None, batch_size=STORAGE_BATCH_SIZE, flush_interval=STORAGE_FLUSH_INTERVAL):
+        # Table, database or index the writer writes to
+        self.target = target
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.written = []  # futures of the buffered entries
+        self._flusher = None
+        # One batch is written at a time, close() waits for the one in flight
+        self._flushing = asyncio.Lock()
+
+    async def start(self):
+        await self.setup()
+        self._flusher = asyncio.ensure_future(self.flush_periodically())
+
+    async def setup(self):
+        pass
+
+    async def teardown(self):
+        pass
+
+    async def write(self, entries):
+        """ Write the batch, return the entries which failed (None if all of them were written) """
+        raise NotImplementedError
+
+    async def add(self, entry):
+        """ Buffer the entry, return the future of whether it has been written """
+        written = asyncio.Future()
+        self.buffer.append(entry)
+        self.written.append(written)
+        if len(self.buffer) >= self.batch_size:
+            # The batch holds entries of other publishers too, it is written even if this one gets cancelled
+            await asyncio.shield(self.flush())
+        return written
+
+    async def flush(self):
+        async with self._flushing:
+            await self.write_buffer()
+
+    async def write_buffer(self):
+        entries, self.buffer = self.buffer, []
+        written, self.written = self.written, []
+        if not entries:
+            return
+        try:
+            with metrics.timer('sink_write_seconds', self.name):
+                failed = await self.write(entries) or []
+        except asyncio.CancelledError:
+            for future in written:
+                if not future.done():
+                    future.set_result(False)
+            raise
+        except Exception as e:
+            failed = entries
+            metrics.inc('errors', self.name, e.__class__.__name__)
+            logger_debug.error('{}: {} - {} entries not written'.format(e.__class__.__name__, self.name,
+                                                                         len(entries)))
+        failed_ids = {id(entry) for entry in failed}
+        metrics.inc('sink_written', self.name, value=len(entries) - len(failed_ids))
+        if failed_ids:
+            metrics.inc('sink_failed', self.name, value=len(failed_ids))
+        # The entries of a failed write are not taken as done, so they are downloaded again next run
+        for entry, future in zip(entries, written):
+            if not future.done():
+                future.set_result(id(entry) not in failed_ids)
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # Cancelling the flusher in close() does not cut a write short
+            await asyncio.shield(self.flush())
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+        await self.teardown()
+
+
+def link_id(link):
+    return hashlib.sha1(link.encode('utf-8')).hexdigest()
+
+
+def entry_document(entry):
+    document = {'_id': link_id(entry.link), 'rss': entry.publisher.name, 'title': entry.title, 'body': entry.main_text,
+                'pub_time': entry.publish_dt, 'link': entry.link}
+    if entry.duplicate_of:
+        document['duplicate_of'] = entry.duplicate_of
+    return document
 
 
-async def save_entry(entry, logger_bucket=None):
-    if len(entry.main_text) > TEXT_SIZE_LIMIT or entry.country == 'Другие':
-        return False
-    if USE_POSTGRESQL:
-        await output_to_sql_async(entry)
-    if USE_MONGODB:
-        await output_to_mongodb_async(entry)
-    if USE_ELASTICSEARCH:
-        await output_to_elasticsearch_async(entry)
-
-
-async def output_to_sql_async(entry):
-    async with create_engine(user=PG_USER,
-                             database=PG_DB,
-                             host='127.0.0.1',
-                             password=PG_PASSWORD) as engine:
-        await create_tables(engine)
-
-        async with engine.acquire() as conn:
-            try:
-                await conn.execute(
-                    countries_tbl.insert().values(name=entry.country, slug=slugify(entry.country)))
-            except IntegrityError:
-                pass
-            try:
-                await conn.execute(
-                    news_tbl.insert().values(rss=entry.publisher.name, title=entry.title, body=entry.main_text,
-                                             pub_time=entry.publish_dt, country_id=entry.country, link=entry.link))
-            except IntegrityError:
-                pass
-
-
-async def output_to_mongodb_async(entry):
-    collection = MONGO_DB[entry.country]
-    document = {'rss': entry.publisher.name, 'title': entry.title, 'body': entry.main_text,
-                'pub_time': entry.publish_dt, 'link': entry.link}
-    result = await collection.update(document, document, upsert=True)
+writers = []
+
+
+async def open_storages():
+    """ Create the long-lived writers of enabled storages, should be called once at startup """
+    for enabled, module_name, class_name in STORAGES:
+        if not enabled:
+            continue
+        writer_class = getattr(importlib.import_module(module_name), class_name)
+        targets = {}
+        for profile in topic_profiles:
+            if writer_class.name in profile.sinks:
+                targets.setdefault(profile.sinks[writer_class.name], set()).add(profile.name)
+        for target, topics in targets.items():
+            writer = writer_class(target=target)
+            writer.topics = topics
+            await writer.start()
+            writers.append(writer)
+
+
+async def close_storages():
+    """ Flush whatever is buffered and release connections """
+    while writers:
+        await writers.pop().close()
+
 
+def stored_topics(entry):
+    """ Topics of the entry which have a country for it """
+    return [topic for topic in entry.topics if entry.countries.get(topic, DEFAULT_COUNTRY) != DEFAULT_COUNTRY]
 
-async def output_to_elasticsearch_async(entry):
-    body = {'rss': entry.publisher.name, 'title': entry.title, 'body': entry.main_text,
-            'pub_time': entry.publish_dt, 'link': entry.link}
-    result = await es_client.index(index='harvester', doc_type=entry.country, body=body)
-    print(result)
+
+def rejection_reason(entry):
+    """ Why save_entry does not store the entry: 'size', 'country' (for none of its topics) or None """
+    if len(entry.main_text) > TEXT_SIZE_LIMIT:
+        return 'size'
+    if not stored_topics(entry):
+        return 'country'
+    return None
+
+
+def all_written(futures):
+    """ Future of whether every one of the writes has succeeded """
+    done = asyncio.Future()
+
+    def check(_):
+        if not done.done() and all(future.done() for future in futures):
+            done.set_result(all(not future.cancelled() and future.result() for future in futures))
+
+    if not futures:
+        done.set_result(True)
+    for future in futures:
+        future.add_done_callback(check)
+    return done
+
+
+async def save_entry(entry, logger_bucket=None):
+    """
+    Route the entry to the writers of every topic it is stored for. Return the names of these topics and
+    the future of whether all the writes have succeeded.
+    """
+    if rejection_reason(entry):
+        return [], all_written([])
+    if NEAR_DUP_MODE != 'off':
+        canonical = near_duplicates.check(entry.link, entry.main_text)
+        if canonical:
+            metrics.inc('entries', entry.publisher.name, 'near_duplicate')
+            if NEAR_DUP_MODE == 'skip':
+                return [], all_written([])
+            # Stored as a reference, the text is kept with the canonical article only
+            entry.duplicate_of = canonical
+            entry.main_text = ''
+    topics = stored_topics(entry)
+    written = []
+    for topic in topics:
+        routed = entry.for_topic(topic)
+        for writer in writers:
+            if writer.topics is None or topic in writer.topics:
+                written.append(await writer.add(routed))
+    return topics, all_written(written)
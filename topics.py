@@ -0,0 +1,59 @@
+import collections
+
+from classifier import CountryClassifier
+from matcher import KeywordMatcher
+from settings import TOPIC_PROFILES, TOPICS, COUNTRY_POLICY
+
+
+class TopicProfile():
+    """ Title filter, country map and storage targets of one topic """
+
+    def __init__(self, name, keyword_file, stop_words, countries_keywords, sinks, country_policy=COUNTRY_POLICY):
+        self.name = name
+        self.matcher = KeywordMatcher(keyword_file, stop_words)
+        self.classifier = CountryClassifier(countries_keywords, policy=country_policy)
+        # Storage name -> table, database or index
+        self.sinks = dict(sinks)
+
+    @property
+    def countries(self):
+        return self.classifier.countries
+
+    def matches(self, title):
+        return self.matcher.matches(title)
+
+    def define_country(self, title, text=''):
+        """ Country by the title, if there is none by the text (only its beginning is relevant), otherwise None """
+        return self.classifier.define_country(title) or (text and self.classifier.define_country(text[:350])) or None
+
+
+class TopicProfiles():
+    """ The profiles evaluated in this run, in the order of TOPICS """
+
+    def __init__(self, definitions):
+        self.definitions = definitions
+        self.profiles = collections.OrderedDict()
+
+    def select(self, names):
+        unknown = [name for name in names if name not in self.definitions]
+        if unknown:
+            raise ValueError('Unknown topics: {}'.format(', '.join(unknown)))
+        self.profiles = collections.OrderedDict((name, TopicProfile(name, **self.definitions[name])) for name in names)
+
+    @property
+    def names(self):
+        return list(self.profiles)
+
+    def __getitem__(self, name):
+        return self.profiles[name]
+
+    def __iter__(self):
+        return iter(self.profiles.values())
+
+    def match(self, title):
+        """ Names of the profiles the title matches, empty if none """
+        return [profile.name for profile in self if profile.matches(title)]
+
+
+topic_profiles = TopicProfiles(TOPIC_PROFILES)
+topic_profiles.select(TOPICS)
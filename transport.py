@@ -0,0 +1,86 @@
+import collections
+
+import aiohttp
+
+from metrics import metrics
+from scheduler import scheduler
+from settings import (USER_AGENT, HTTP_KEEPALIVE, HTTP_DNS_TTL,
+                      FEED_CONNECT_TIMEOUT, FEED_READ_TIMEOUT, ARTICLE_CONNECT_TIMEOUT, ARTICLE_READ_TIMEOUT,
+                      logger_debug)
+
+HEADERS = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip, deflate'}
+
+
+async def close(resource):
+    """ close() of sessions and connectors is a coroutine in newer aiohttp versions and a plain method in older ones """
+    closing = resource.close()
+    if closing is not None:
+        await closing
+
+
+class CountingConnector(aiohttp.TCPConnector):
+    """ Counts per host how many requests got a connection and how many of them had to open a new one """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests = collections.Counter()
+        self.created = collections.Counter()
+
+    async def connect(self, req, *args, **kwargs):
+        self.requests[req.host] += 1
+        return await super().connect(req, *args, **kwargs)
+
+    async def _create_connection(self, req, *args, **kwargs):
+        self.created[req.host] += 1
+        return await super()._create_connection(req, *args, **kwargs)
+
+    def stats(self):
+        return {host: {'requests': count, 'new': self.created[host], 'reused': count - self.created[host]}
+                for host, count in self.requests.items()}
+
+
+class Transport():
+    """
+    HTTP client of a run: one connector with keep-alive and a DNS cache, shared by a session for feeds
+    and a session for articles, which differ in their connect and read timeouts.
+
+        async with Transport(loop) as transport:
+            await transport.feeds.request('GET', url)
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.connector = None
+        self.feeds = None
+        self.articles = None
+
+    async def __aenter__(self):
+        # The scheduler keeps the requests within its limits already, the pool just has to fit them
+        self.connector = CountingConnector(loop=self.loop, limit=scheduler.max_requests,
+                                           limit_per_host=scheduler.max_per_host,
+                                           keepalive_timeout=HTTP_KEEPALIVE, use_dns_cache=True,
+                                           ttl_dns_cache=HTTP_DNS_TTL)
+        self.feeds = aiohttp.ClientSession(loop=self.loop, connector=self.connector, connector_owner=False,
+                                           headers=HEADERS, conn_timeout=FEED_CONNECT_TIMEOUT,
+                                           read_timeout=FEED_READ_TIMEOUT)
+        self.articles = aiohttp.ClientSession(loop=self.loop, connector=self.connector, connector_owner=False,
+                                              headers=HEADERS, conn_timeout=ARTICLE_CONNECT_TIMEOUT,
+                                              read_timeout=ARTICLE_READ_TIMEOUT)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await close(self.feeds)
+        await close(self.articles)
+        await close(self.connector)
+        self.export_stats()
+
+    def export_stats(self):
+        """ Connection reuse per host to the metrics, totals to the log """
+        stats = self.connector.stats()
+        for host, host_stats in stats.items():
+            metrics.inc('http_connections', host, 'new', host_stats['new'])
+            metrics.inc('http_connections', host, 'reused', host_stats['reused'])
+        requests = sum(host_stats['requests'] for host_stats in stats.values())
+        reused = sum(host_stats['reused'] for host_stats in stats.values())
+        logger_debug.info('Connections: {} requests to {} hosts, {} on reused connections'.format(
+            requests, len(stats), reused))